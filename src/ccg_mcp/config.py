@@ -189,3 +189,21 @@ def reset_config_cache() -> None:
     """重置配置缓存（主要用于测试）"""
     global _config_cache
     _config_cache = None
+
+
+# 单个工具默认同时运行的 CLI 进程上限
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+def get_max_concurrency() -> int:
+    """获取单个工具同时运行的 CLI 进程上限
+
+    从环境变量 CCG_MCP_MAX_CONCURRENCY 读取，未设置或取值无效时使用默认值 4。
+
+    Returns:
+        并发上限（至少为 1）
+    """
+    try:
+        return max(1, int(os.environ.get("CCG_MCP_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)))
+    except ValueError:
+        return DEFAULT_MAX_CONCURRENCY
@@ -1,17 +1,21 @@
 """CCG-MCP 服务器主体
 
-提供 coder、codex 和 gemini 三个 MCP 工具，实现多方协作。
+提供 claude、coder、codex 和 gemini 四个 MCP 工具，以及并发调度它们的 multi 工具、
+Claude 后台任务工具（claude_async / claude_poll / claude_cancel），实现多方协作。
 """
 
 from __future__ import annotations
 
+import asyncio
+import time
+import uuid
 from pathlib import Path
 from typing import Annotated, Any, Dict, List, Literal, Optional
 
-from mcp.server.fastmcp import FastMCP
-from pydantic import Field
+from mcp.server.fastmcp import Context, FastMCP
+from pydantic import Field, ValidationError, validate_call
 
-from ccg_mcp.tools.claude import claude_tool
+from ccg_mcp.tools.claude import ErrorKind, claude_tool
 from ccg_mcp.tools.coder import coder_tool
 from ccg_mcp.tools.codex import codex_tool
 from ccg_mcp.tools.gemini import gemini_tool
@@ -19,6 +23,54 @@ from ccg_mcp.tools.gemini import gemini_tool
 # 创建 MCP 服务器实例
 mcp = FastMCP("CCG-MCP Server")
 
+# multi 工具可调度的子工具：经 validate_call 包装，与直接调用各 MCP 工具一样校验参数
+# （Literal / Path / int 等），避免 sandbox="readonly" 之类的拼写错误被当作可写模式执行
+_TOOL_HANDLERS = {
+    "claude": validate_call(claude_tool),
+    "coder": validate_call(coder_tool),
+    "codex": validate_call(codex_tool),
+    "gemini": validate_call(gemini_tool),
+}
+
+# claude_async 启动的后台任务：job_id -> asyncio.Task
+_JOBS: Dict[str, asyncio.Task[Dict[str, Any]]] = {}
+# 已完成任务的完成时间（单调时钟）：job_id -> 时间戳，按完成先后排列
+_JOB_DONE_AT: Dict[str, float] = {}
+
+# 已完成但未取回的结果最多保留的时长（秒）与数量，超出后丢弃最早完成的结果
+JOB_RESULT_TTL = 3600
+MAX_FINISHED_JOBS = 100
+
+
+def _mark_job_done(job_id: str) -> None:
+    """后台任务结束时记录完成时间（已被 claude_cancel 移除的任务不再记录）"""
+    if job_id in _JOBS:
+        _JOB_DONE_AT[job_id] = time.monotonic()
+
+
+def _evict_finished_jobs() -> None:
+    """丢弃超过 JOB_RESULT_TTL 或超出 MAX_FINISHED_JOBS 的已完成任务，避免无人取回的结果一直占用内存"""
+    expire_before = time.monotonic() - JOB_RESULT_TTL
+    while _JOB_DONE_AT:
+        job_id, done_at = next(iter(_JOB_DONE_AT.items()))
+        if done_at > expire_before and len(_JOB_DONE_AT) <= MAX_FINISHED_JOBS:
+            break
+        del _JOB_DONE_AT[job_id]
+        task = _JOBS.pop(job_id)
+        if not task.cancelled():
+            task.exception()  # 标记异常已取回，避免任务被回收时输出告警
+
+
+def _job_not_found(job_id: str) -> Dict[str, Any]:
+    """未知或已过期的 job_id"""
+    return {
+        "success": False,
+        "tool": "claude",
+        "job_id": job_id,
+        "status": "not_found",
+        "error": f"未知的 job_id：{job_id}（可能已取回结果、已取消或已过期）",
+    }
+
 
 @mcp.tool(
     name="claude",
@@ -79,6 +131,114 @@ async def claude(
     )
 
 
+@mcp.tool(
+    name="claude_async",
+    description="""
+    以后台任务方式调用 Claude，立即返回 job_id，不阻塞当前会话。
+
+    **使用场景**：
+    - 预计耗时很长（可能超过 MCP 客户端超时）的咨询或执行任务
+    - 希望在 Claude 执行期间继续调用其他工具
+
+    **配套工具**：
+    - `claude_poll(job_id)`：查询状态，完成后返回与 `claude` 工具相同的结果
+    - `claude_cancel(job_id)`：取消任务并终止 Claude 进程
+
+    参数与 `claude` 工具一致。
+    """,
+)
+async def claude_async(
+    PROMPT: Annotated[str, "发送给 Claude 的咨询或任务指令"],
+    cd: Annotated[Path, "工作目录"],
+    sandbox: Annotated[
+        Literal["read-only", "workspace-write", "danger-full-access"],
+        Field(description="沙箱策略，默认允许写工作区"),
+    ] = "workspace-write",
+    SESSION_ID: Annotated[str, "会话 ID，用于多轮对话"] = "",
+    return_all_messages: Annotated[bool, "是否返回完整消息"] = False,
+    return_metrics: Annotated[bool, "是否在返回值中包含指标数据"] = False,
+    timeout: Annotated[int, "空闲超时（秒），无输出超过此时间触发超时，默认 300 秒"] = 300,
+    max_duration: Annotated[int, "总时长硬上限（秒），默认 1800 秒（30 分钟），0 表示无限制"] = 1800,
+    max_retries: Annotated[int, "最大重试次数，默认 0"] = 0,
+    log_metrics: Annotated[bool, "是否将指标输出到 stderr"] = False,
+) -> Dict[str, Any]:
+    """在后台启动 Claude 任务"""
+    _evict_finished_jobs()
+    job_id = uuid.uuid4().hex
+    task = _JOBS[job_id] = asyncio.create_task(
+        claude_tool(
+            PROMPT=PROMPT,
+            cd=cd,
+            sandbox=sandbox,
+            SESSION_ID=SESSION_ID,
+            return_all_messages=return_all_messages,
+            return_metrics=return_metrics,
+            timeout=timeout,
+            max_duration=max_duration,
+            max_retries=max_retries,
+            log_metrics=log_metrics,
+        )
+    )
+    task.add_done_callback(lambda _: _mark_job_done(job_id))
+    return {"job_id": job_id, "status": "running"}
+
+
+@mcp.tool(
+    name="claude_poll",
+    description="""
+    查询 `claude_async` 后台任务的状态。
+
+    - 执行中：返回 `{"job_id": ..., "status": "running"}`
+    - 已完成：返回 `claude` 工具的完整结果（附带 job_id 和 status），结果只能取回一次
+    - 未知 job_id：返回 `{"job_id": ..., "status": "not_found"}`；完成后 1 小时内未取回的结果会被丢弃
+    """,
+)
+async def claude_poll(
+    job_id: Annotated[str, "claude_async 返回的任务 ID"],
+) -> Dict[str, Any]:
+    """查询后台 Claude 任务"""
+    _evict_finished_jobs()
+    task = _JOBS.get(job_id)
+    if task is None:
+        return _job_not_found(job_id)
+    if not task.done():
+        return {"job_id": job_id, "status": "running"}
+
+    # 结果已取回，释放任务
+    del _JOBS[job_id]
+    _JOB_DONE_AT.pop(job_id, None)
+    if task.cancelled():
+        return {"success": False, "tool": "claude", "job_id": job_id, "status": "cancelled"}
+    exc = task.exception()
+    if exc is not None:
+        return {
+            "success": False,
+            "tool": "claude",
+            "job_id": job_id,
+            "status": "completed",
+            "error": str(exc) or type(exc).__name__,
+            "error_kind": ErrorKind.UNEXPECTED_EXCEPTION,
+            "error_detail": {"message": f"{type(exc).__name__}: {exc}"},
+        }
+    return {"job_id": job_id, "status": "completed", **task.result()}
+
+
+@mcp.tool(
+    name="claude_cancel",
+    description="取消 `claude_async` 后台任务，并终止对应的 Claude 进程。",
+)
+async def claude_cancel(
+    job_id: Annotated[str, "claude_async 返回的任务 ID"],
+) -> Dict[str, Any]:
+    """取消后台 Claude 任务"""
+    task = _JOBS.pop(job_id, None)
+    if task is None:
+        return _job_not_found(job_id)
+    _JOB_DONE_AT.pop(job_id, None)
+    task.cancel()
+    return {"success": True, "tool": "claude", "job_id": job_id, "status": "cancelled"}
+
+
 @mcp.tool(
     name="coder",
     description="""
@@ -100,6 +260,9 @@ async def claude(
 
     **注意**：Coder 需要写权限，默认 sandbox 为 workspace-write
 
+    **增量输出**：请求附带 progressToken 时，执行过程中每段 assistant 文本都会作为进度通知的
+    message 发送，无需等待最终结果；最终结果仍以工具返回值为准
+
     **Prompt 模板**：
     ```
     请执行以下代码任务：
@@ -129,8 +292,17 @@ async def coder(
     max_duration: Annotated[int, "总时长硬上限（秒），默认 1800 秒（30 分钟），0 表示无限制"] = 1800,
     max_retries: Annotated[int, "最大重试次数，默认 0（Coder 有写入副作用，默认不重试）"] = 0,
     log_metrics: Annotated[bool, "是否将指标输出到 stderr"] = False,
+    ctx: Context | None = None,
 ) -> Dict[str, Any]:
     """执行 Coder 代码任务"""
+    chunks = 0
+
+    async def forward_chunk(text: str) -> None:
+        # 以进度通知转发增量文本；客户端未提供 progressToken 时 report_progress 不发送任何内容
+        nonlocal chunks
+        chunks += 1
+        await ctx.report_progress(chunks, message=text)
+
     return await coder_tool(
         PROMPT=PROMPT,
         cd=cd,
@@ -142,6 +314,7 @@ async def coder(
         max_duration=max_duration,
         max_retries=max_retries,
         log_metrics=log_metrics,
+        on_chunk=forward_chunk if ctx is not None else None,
     )
 
 
@@ -303,6 +476,100 @@ async def gemini(
     )
 
 
+@mcp.tool(
+    name="multi",
+    description="""
+    并发调用多个工具（claude / coder / codex / gemini），一次返回全部结果。
+
+    **使用场景**：
+    - 多个互不依赖的子任务（如 Codex 审核 + Gemini 咨询）需要同时进行
+    - 需要多个模型对同一问题给出独立意见
+
+    **优势**：
+    - 各子工具的 CLI 进程并发执行，总耗时取决于最慢的一个，而非所有调用之和
+    - 只需一次工具调用往返，宿主无需为每个子任务重复携带上下文，节省 token
+
+    **注意**：子调用之间互不感知，有依赖关系的任务请按顺序分别调用；
+    多个写入型任务（如多个 coder）请确保改动的文件互不重叠。
+
+    kwargs 按对应工具的参数定义校验，校验失败的子调用返回 error_kind="invalid_arguments"，不会执行。
+
+    **参数格式**：
+    ```
+    [
+      {"tool": "codex", "kwargs": {"PROMPT": "...", "cd": "/path/to/repo"}},
+      {"tool": "gemini", "kwargs": {"PROMPT": "...", "cd": "/path/to/repo"}}
+    ]
+    ```
+    """,
+)
+async def multi(
+    calls: Annotated[
+        List[Dict[str, Any]],
+        Field(description="调用列表，每项包含 tool（工具名）和 kwargs（该工具的参数）"),
+    ],
+) -> List[Dict[str, Any]]:
+    """并发执行多个工具调用，结果顺序与 calls 一致"""
+
+    async def dispatch(call: Dict[str, Any]) -> Dict[str, Any]:
+        tool = call.get("tool", "")
+        handler = _TOOL_HANDLERS.get(tool)
+        if handler is None:
+            return _invalid_call(
+                tool, f"未知工具：{tool!r}，可选值：{', '.join(_TOOL_HANDLERS)}"
+            )
+        kwargs = call.get("kwargs", {})
+        if not isinstance(kwargs, dict):
+            return _invalid_call(tool, "kwargs 必须是对象（参数名到参数值的映射）")
+        try:
+            # 参数在进入工具函数之前校验，校验失败不会启动任何子进程
+            return await handler(**kwargs)
+        except ValidationError as e:
+            return _invalid_call(
+                tool,
+                f"{tool} 参数校验失败：{e.error_count()} 处错误",
+                [{"loc": list(err["loc"]), "msg": err["msg"]} for err in e.errors()],
+            )
+
+    outcomes = await asyncio.gather(
+        *(dispatch(call) for call in calls),
+        return_exceptions=True,
+    )
+
+    results: List[Dict[str, Any]] = []
+    for call, outcome in zip(calls, outcomes):
+        if isinstance(outcome, BaseException):
+            # 与单个工具的失败返回结构保持一致
+            results.append({
+                "success": False,
+                "tool": call.get("tool"),
+                "error": str(outcome) or type(outcome).__name__,
+                "error_kind": ErrorKind.UNEXPECTED_EXCEPTION,
+                "error_detail": {"message": f"{type(outcome).__name__}: {outcome}"},
+            })
+        else:
+            results.append(outcome)
+    return results
+
+
+def _invalid_call(
+    tool: Any,
+    message: str,
+    validation_errors: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """multi 子调用参数无效时的返回结构（与单个工具的失败返回保持一致）"""
+    detail: Dict[str, Any] = {"message": message}
+    if validation_errors:
+        detail["validation_errors"] = validation_errors
+    return {
+        "success": False,
+        "tool": tool,
+        "error": message,
+        "error_kind": ErrorKind.INVALID_ARGUMENTS,
+        "error_detail": detail,
+    }
+
+
 def run() -> None:
     """启动 MCP 服务器"""
     mcp.run(transport="stdio")
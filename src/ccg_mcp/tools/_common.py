@@ -0,0 +1,370 @@
+"""工具模块公共辅助函数"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+from contextlib import asynccontextmanager
+from os import PathLike
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Optional, Sequence, TypeVar
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库
+    orjson = None
+
+
+# ============================================================================
+# JSON 编解码
+# ============================================================================
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，调用方统一捕获后者即可
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def json_dumps(data: Any) -> str:
+    """序列化为 JSON 字符串（保留非 ASCII 字符）"""
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, ensure_ascii=False)
+
+
+def write_stderr_jsonl(data: Any) -> None:
+    """将一条 JSON 记录作为一行写入 stderr
+
+    直接对文件描述符 2 发起一次 write 系统调用，不经过 sys.stderr 的文本层和锁，
+    并发调用时每条记录也保持完整的一行。
+
+    Raises:
+        OSError: 写入失败时抛出，由调用方决定是否忽略
+    """
+    if orjson is not None:
+        payload = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    else:
+        payload = (json.dumps(data, ensure_ascii=False) + "\n").encode('utf-8')
+    os.write(2, payload)
+
+
+# ============================================================================
+# CLI 查找
+# ============================================================================
+
+
+@functools.lru_cache(maxsize=8)
+def _which(name: str, path_env: Optional[str]) -> str:
+    """按 (命令名, PATH) 缓存 shutil.which 的结果"""
+    path = shutil.which(name, path=path_env)
+    if not path:
+        raise FileNotFoundError(name)
+    return path
+
+
+def resolve_cli(name: str) -> str:
+    """查找 CLI 可执行文件的完整路径（进程内缓存）
+
+    shutil.which 每次都要遍历 PATH 并逐个 stat 候选文件，Windows 上尤其昂贵。
+    找到的路径按当前 PATH 缓存：PATH 变化后自动重新查找；
+    PATH 不变时 CLI 升级或移动位置需重启 MCP 服务器生效。
+    未找到时抛出的异常不会被缓存，安装 CLI 后下一次调用即可找到。
+
+    Raises:
+        FileNotFoundError: PATH 中不存在该命令时抛出
+    """
+    return _which(name, os.environ.get("PATH"))
+
+
+# ============================================================================
+# 子进程管理
+# ============================================================================
+
+# asyncio 子进程 stdout 的单行长度上限：stream-json 单行可能包含完整文件内容，
+# StreamReader 默认的 64KB 不够；超过上限的行会被整行丢弃（见 read_line）
+STREAM_LIMIT = 1 << 20
+
+# 超长行被丢弃后，run_cli_command 以此占位输出：非 JSON，下游按解析失败计数一次，
+# last_lines 中只留下诊断信息而不含原始内容（原始内容可能是未脱敏的 tool_result）
+OVERSIZED_LINE = "ccg-mcp: 输出行超过 STREAM_LIMIT（1 MiB），已整行丢弃".encode('utf-8')
+
+# CLI 常会派生子进程（如 Node 辅助进程），将其放入独立的进程组/会话，
+# 清理时才能连同子进程一起终止，避免残留进程占用管道拖慢退出
+if os.name == 'nt':
+    PROCESS_GROUP_KWARGS: dict[str, Any] = {
+        "creationflags": subprocess.CREATE_NEW_PROCESS_GROUP,
+    }
+else:
+    PROCESS_GROUP_KWARGS = {"start_new_session": True}
+
+# 读到完成帧后等待 CLI 关闭输出的最长时间（读到 EOF 即提前结束）
+DRAIN_TIMEOUT = 0.3
+
+_T = TypeVar("_T")
+
+
+class CommandNotFoundError(Exception):
+    """命令不存在错误"""
+    pass
+
+
+class CommandTimeoutError(Exception):
+    """命令执行超时错误"""
+    def __init__(self, message: str, is_idle: bool = False):
+        super().__init__(message)
+        self.is_idle = is_idle  # 标记是否为空闲超时
+
+
+class CommandResult:
+    """子进程执行结果，由 run_cli_command 在运行过程中填充
+
+    异步生成器无法通过 return 返回值，调用方传入此对象，生成器结束后读取。
+    """
+
+    __slots__ = ("exit_code", "raw_output_lines")
+
+    def __init__(self) -> None:
+        self.exit_code: Optional[int] = None  # 进程正常结束时的退出码；超时、提前关闭时为 None
+        self.raw_output_lines = 0  # 非空输出行数
+
+
+def signal_process_group(process: Any, force: bool = False) -> None:
+    """终止以 PROCESS_GROUP_KWARGS 启动的子进程及其所在进程组
+
+    POSIX 上向整个进程组发送 SIGTERM（force 时为 SIGKILL），子进程已退出时组内残留的进程同样会收到；
+    Windows 没有进程组信号，退回到只终止子进程本身（已退出时不做任何事）。
+
+    Raises:
+        ProcessLookupError: 进程组已不存在时抛出，由调用方忽略
+    """
+    if os.name == 'nt':
+        if process.returncode is not None:
+            return
+        if force:
+            process.kill()
+        else:
+            process.terminate()
+        return
+    os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+
+
+async def read_line(stream: asyncio.StreamReader) -> Optional[bytes]:
+    """读取一行（含换行符），EOF 时返回 b""；超过 STREAM_LIMIT 的行整行丢弃并返回 None
+
+    StreamReader.readline 遇到超长行时只清掉已缓冲的部分，该行剩余内容会在下一次读取时
+    作为"新的一行"返回，可能泄露未脱敏的内容。这里改用 readuntil，超长时持续丢弃直到换行。
+    """
+    discarding = False
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return None if discarding else e.partial  # EOF，最后一行可能没有换行符
+        except asyncio.LimitOverrunError as e:
+            # 丢弃已缓冲的部分（数据仍在缓冲区中，readexactly 不会等待），继续读到换行为止
+            await stream.readexactly(e.consumed)
+            discarding = True
+            continue
+        return None if discarding else line
+
+
+def decode_line(raw: bytes) -> str:
+    """将输出行解码为文本（非法 UTF-8 以替换字符代替），用作按文本处理输出的工具的 parse"""
+    return raw.decode('utf-8', errors='replace')
+
+
+async def drain_stream(stream: asyncio.StreamReader, max_wait: float) -> None:
+    """读取并丢弃流中剩余的输出，直到 EOF 或超过 max_wait 秒
+
+    会话结束后 CLI 通常会立即退出并关闭 stdout，读到 EOF 即返回，
+    不必固定等待；CLI 迟迟不退出时最多等待 max_wait 秒。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        try:
+            if await asyncio.wait_for(read_line(stream), timeout=remaining) == b"":
+                return  # EOF（超长行返回 None，继续读取）
+        except asyncio.TimeoutError:
+            return
+
+
+async def run_cli_command(
+    argv: Sequence[str],
+    *,
+    name: str,
+    prompt: str | bytes = "",
+    env: Optional[dict[str, str]] = None,
+    cwd: str | PathLike[str] | None = None,
+    timeout: int = 300,
+    max_duration: int = 1800,
+    parse: Callable[[bytes], _T],
+    is_done: Callable[[_T], bool],
+    result: Optional[CommandResult] = None,
+) -> AsyncGenerator[_T, None]:
+    """执行 CLI 命令并流式返回解析后的输出行（异步生成器）
+
+    基于 asyncio 子进程逐行读取输出，每次读取的等待上限取空闲超时与剩余总时长中的较小者，
+    由事件循环定时器精确唤醒，无需读取线程和轮询。子进程由生成器自身持有，
+    生成器结束、关闭（aclose）或被取消时都会清理子进程及其所在进程组。
+
+    Args:
+        argv: 完整命令行，argv[0] 为已解析的可执行文件路径
+        name: 工具名，用于超时错误信息
+        prompt: 通过 stdin 传递的 prompt（bytes 按 UTF-8 原样写入，不再编码）
+        env: 环境变量字典，None 表示继承当前进程
+        cwd: 工作目录
+        timeout: 空闲超时（秒），无输出超过此时间触发超时，默认 300 秒（5 分钟）
+        max_duration: 总时长硬上限（秒），默认 1800 秒（30 分钟），0 表示无限制
+        parse: 将去除首尾空白后的非空输出行（bytes）转换为产出值
+        is_done: 判断产出值是否为完成帧；读到完成帧后最多再等待 DRAIN_TIMEOUT 秒即结束
+        result: 可选的结果对象，运行中写入非空输出行数，进程结束后写入退出码
+
+    Yields:
+        parse 的返回值
+
+    Raises:
+        CommandTimeoutError: 命令执行超时时抛出
+    """
+    if result is None:
+        result = CommandResult()
+
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        env=env,
+        cwd=cwd,
+        limit=STREAM_LIMIT,
+        **PROCESS_GROUP_KWARGS,
+    )
+
+    try:
+        # 通过 stdin 传递 prompt，然后关闭 stdin
+        if process.stdin:
+            try:
+                if prompt:
+                    process.stdin.write(prompt if isinstance(prompt, bytes) else prompt.encode('utf-8'))
+                    await process.stdin.drain()
+            except (BrokenPipeError, OSError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+
+        # 总时长截止时间（单调时钟），0 表示无限制
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_duration if max_duration > 0 else None
+
+        assert process.stdout is not None
+        while True:
+            wait_s: float = timeout
+            is_idle = True
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining < wait_s:
+                    wait_s = max(remaining, 0)
+                    is_idle = False
+            try:
+                raw = await asyncio.wait_for(read_line(process.stdout), timeout=wait_s)
+            except asyncio.TimeoutError:
+                if is_idle:
+                    raise CommandTimeoutError(
+                        f"{name} 空闲超时（{timeout}s 无输出），进程已终止。",
+                        is_idle=True
+                    )
+                raise CommandTimeoutError(
+                    f"{name} 执行超时（总时长超过 {max_duration}s），进程已终止。",
+                    is_idle=False
+                )
+            if raw is None:
+                raw = OVERSIZED_LINE  # 单行超过 STREAM_LIMIT，已整行丢弃，以占位行代替
+            elif not raw:
+                break  # EOF
+            # 任意行都重置空闲计时，但只产出非空行；在字节层面 strip 一次，下游不再重复 strip
+            raw = raw.strip()
+            if not raw:
+                continue
+            item = parse(raw)
+            result.raw_output_lines += 1
+            yield item
+            if is_done(item):
+                await drain_stream(process.stdout, DRAIN_TIMEOUT)
+                break
+
+        try:
+            result.exit_code = await asyncio.wait_for(process.wait(), timeout=5)  # 此时进程应已结束，短超时即可
+        except asyncio.TimeoutError:
+            raise CommandTimeoutError(
+                f"{name} 进程等待超时，进程已终止。",
+                is_idle=False
+            )
+
+    finally:
+        # 清理子进程（best-effort，不抛异常）
+        # CLI 自身已退出时，它派生的后台进程仍可能存活并持有输出管道，因此总是向进程组发送信号
+        try:
+            signal_process_group(process)
+        except (ProcessLookupError, OSError):
+            pass  # 进程组已不存在，忽略
+        try:
+            if process.returncode is None:
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    signal_process_group(process, force=True)
+                    try:
+                        await asyncio.wait_for(process.wait(), timeout=2)  # kill 后也设超时
+                    except asyncio.TimeoutError:
+                        pass  # 极端情况：进程无法终止，放弃
+            # 读到 EOF 使输出管道随之关闭，否则管道要到事件循环关闭时才被回收
+            if process.stdout is not None:
+                await drain_stream(process.stdout, 2)
+        except (ProcessLookupError, OSError):
+            pass  # 进程已退出，忽略
+
+
+@asynccontextmanager
+async def safe_cli_command(argv: Sequence[str], **kwargs: Any) -> AsyncIterator[AsyncGenerator[Any, None]]:
+    """安全执行 CLI 命令的异步上下文管理器
+
+    包装 run_cli_command（参数相同），退出上下文时显式关闭生成器，
+    确保在任何情况下（包括异常、任务取消、提前 break）都能立即清理子进程，
+    而不是等到生成器被垃圾回收。
+
+    用法:
+        async with safe_cli_command(argv, name="codex", parse=parse, is_done=is_done) as gen:
+            async for item in gen:
+                process_item(item)
+    """
+    gen = run_cli_command(argv, **kwargs)
+    try:
+        yield gen
+    finally:
+        await gen.aclose()
+
+
+# ============================================================================
+# 重试退避
+# ============================================================================
+
+# 退避参数：delay = uniform(0, min(base * 2^attempt, cap))（full jitter）
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+
+def retry_policy(attempt: int) -> float:
+    """计算第 attempt 次重试（从 0 开始）前的等待秒数
+
+    全抖动指数退避：在 [0, 指数上限] 内均匀取值，上游故障时多个调用的重试时刻充分错开。
+    """
+    return random.uniform(0, min(RETRY_BASE_DELAY * (2 ** attempt), RETRY_MAX_DELAY))
@@ -6,37 +6,31 @@ Claude 在 CCG 流程中担任专家咨询角色。
 
 from __future__ import annotations
 
+import asyncio
+import io
 import json
-import queue
-import shutil
-import subprocess
-import sys
-import threading
 import time
-from contextlib import contextmanager
-from datetime import datetime, timezone
+from collections import deque
+from contextlib import AbstractAsyncContextManager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Annotated, Any, Dict, Generator, Iterator, Literal, Optional
+from typing import Annotated, Any, AsyncGenerator, Dict, Iterable, Literal, Optional
 
 from pydantic import Field
 
-from ccg_mcp.config import build_claude_env, get_config
-
-
-# ============================================================================ 
-# 错误类型定义
-# ============================================================================ 
-
-class CommandNotFoundError(Exception):
-    """命令不存在错误"""
-    pass
-
-
-class CommandTimeoutError(Exception):
-    """命令执行超时错误"""
-    def __init__(self, message: str, is_idle: bool = False):
-        super().__init__(message)
-        self.is_idle = is_idle  # 标记是否为空闲超时
+from ccg_mcp.config import build_claude_env, get_config, get_max_concurrency
+from ccg_mcp.tools._common import (
+    CommandNotFoundError,
+    CommandResult,
+    CommandTimeoutError,
+    decode_line,
+    json_dumps,
+    json_loads,
+    resolve_cli,
+    retry_policy,
+    safe_cli_command,
+    write_stderr_jsonl,
+)
 
 
 # ============================================================================ 
@@ -54,6 +48,7 @@ class ErrorKind:
     EMPTY_RESULT = "empty_result"
     SUBPROCESS_ERROR = "subprocess_error"
     CONFIG_ERROR = "config_error"
+    INVALID_ARGUMENTS = "invalid_arguments"  # multi 子调用的参数未通过校验
     UNEXPECTED_EXCEPTION = "unexpected_exception"
 
 
@@ -64,20 +59,41 @@ class ErrorKind:
 class MetricsCollector:
     """指标收集器"""
 
+    # 每次工具调用都会创建一个实例，固定属性集合，省去实例 __dict__
+    __slots__ = (
+        "tool",
+        "sandbox",
+        "prompt_chars",
+        "_prompt",
+        "ts_start",
+        "_t0",
+        "_finished",
+        "duration_ms",
+        "success",
+        "error_kind",
+        "retries",
+        "exit_code",
+        "result_chars",
+        "_result",
+        "raw_output_lines",
+        "json_decode_errors",
+    )
+
     def __init__(self, tool: str, prompt: str, sandbox: str):
         self.tool = tool
         self.sandbox = sandbox
         self.prompt_chars = len(prompt)
-        self.prompt_lines = prompt.count('\n') + 1
+        self._prompt = prompt  # 行数仅在输出指标时才统计
         self.ts_start = datetime.now(timezone.utc)
-        self.ts_end: Optional[datetime] = None
+        self._t0 = time.perf_counter_ns()  # 单调高精度计时，不受系统时钟调整影响
+        self._finished = False
         self.duration_ms: int = 0
         self.success: bool = False
         self.error_kind: Optional[str] = None
         self.retries: int = 0
         self.exit_code: Optional[int] = None
         self.result_chars: int = 0
-        self.result_lines: int = 0
+        self._result = ""
         self.raw_output_lines: int = 0
         self.json_decode_errors: int = 0
 
@@ -92,22 +108,40 @@ class MetricsCollector:
         retries: int = 0,
     ) -> None:
         """完成指标收集"""
-        self.ts_end = datetime.now(timezone.utc)
-        self.duration_ms = int((self.ts_end - self.ts_start).total_seconds() * 1000)
+        self.duration_ms = (time.perf_counter_ns() - self._t0) // 1_000_000
+        self._finished = True
         self.success = success
         self.error_kind = error_kind
         self.result_chars = len(result)
-        self.result_lines = result.count('\n') + 1 if result else 0
+        self._result = result
         self.exit_code = exit_code
         self.raw_output_lines = raw_output_lines
         self.json_decode_errors = json_decode_errors
         self.retries = retries
 
+    @property
+    def ts_end(self) -> Optional[datetime]:
+        """结束时间（由起始时间加耗时推算，finish 之前为 None）"""
+        if not self._finished:
+            return None
+        return self.ts_start + timedelta(milliseconds=self.duration_ms)
+
+    @property
+    def prompt_lines(self) -> int:
+        """Prompt 行数（按需统计，避免每次调用都扫描大 Prompt）"""
+        return self._prompt.count('\n') + 1
+
+    @property
+    def result_lines(self) -> int:
+        """结果行数（按需统计）"""
+        return self._result.count('\n') + 1 if self._result else 0
+
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典"""
+        ts_end = self.ts_end
         return {
             "ts_start": self.ts_start.isoformat() if self.ts_start else None,
-            "ts_end": self.ts_end.isoformat() if self.ts_end else None,
+            "ts_end": ts_end.isoformat() if ts_end else None,
             "duration_ms": self.duration_ms,
             "tool": self.tool,
             "sandbox": self.sandbox,
@@ -136,7 +170,7 @@ class MetricsCollector:
         # 移除 None 值以减少输出
         metrics = {k: v for k, v in metrics.items() if v is not None}
         try:
-            print(json.dumps(metrics, ensure_ascii=False), file=sys.stderr)
+            write_stderr_jsonl(metrics)
         except Exception:
             pass  # 静默失败，不影响主流程
 
@@ -145,208 +179,88 @@ class MetricsCollector:
 # 命令执行
 # ============================================================================ 
 
-@contextmanager
+def _is_session_completed(line: str) -> bool:
+    """检查是否会话完成（stream-json 格式）"""
+    # 快速路径：CLI 输出紧凑 JSON，绝大多数行不含终止类型，无需完整解析；
+    # 即使漏判也只是改为读到 EOF 才结束，不影响正确性
+    if '"type":"result"' not in line and '"type":"error"' not in line:
+        return False
+    try:
+        data = json_loads(line)
+        # stream-json 格式：result 或 error 类型表示会话结束
+        return data.get("type") in ("result", "error")
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        return False
+
+
 def safe_claude_command(
     cmd: list[str],
     env: dict[str, str],
     cwd: Path | None = None,
     timeout: int = 300,
     max_duration: int = 1800,
-    prompt: str = "",
-) -> Iterator[Generator[str, None, tuple[Optional[int], int]]]:
-    """安全执行 Claude 命令的上下文管理器"""
-    claude_path = shutil.which('claude')
-    if not claude_path:
+    prompt: str | bytes = "",
+    result: Optional[CommandResult] = None,
+) -> AbstractAsyncContextManager[AsyncGenerator[str, None]]:
+    """安全执行 Claude 命令的异步上下文管理器，逐行产出解码后的输出
+
+    子进程管理、超时与清理见 run_cli_command / safe_cli_command。
+
+    用法:
+        async with safe_claude_command(cmd, env, cwd, timeout, max_duration, prompt) as gen:
+            async for line in gen:
+                process_line(line)
+
+    Raises:
+        CommandNotFoundError: claude CLI 未安装时抛出
+    """
+    try:
+        claude_path = resolve_cli('claude')
+    except FileNotFoundError:
         raise CommandNotFoundError(
             "未找到 claude CLI。请确保已安装 Claude Code CLI 并添加到 PATH。"
-        )
-    popen_cmd = cmd.copy()
-    popen_cmd[0] = claude_path
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
-        errors='replace',
+        ) from None
+    return safe_cli_command(
+        [claude_path, *cmd[1:]],
+        name="claude",
+        prompt=prompt,
         env=env,
         cwd=cwd,
+        timeout=timeout,
+        max_duration=max_duration,
+        parse=decode_line,
+        is_done=_is_session_completed,
+        result=result,
     )
 
-    thread: Optional[threading.Thread] = None
 
-    def cleanup() -> None:
-        """清理子进程和线程"""
-        nonlocal thread
-        try:
-            if process.stdout and not process.stdout.closed:
-                process.stdout.close()
-        except (OSError, IOError):
-            pass
-        try:
-            if process.poll() is None:
-                process.terminate()
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    try:
-                        process.wait(timeout=2)
-                    except subprocess.TimeoutExpired:
-                        pass
-        except (ProcessLookupError, OSError):
-            pass
-        if thread is not None and thread.is_alive():
-            thread.join(timeout=5)
-
-    try:
-        if process.stdin:
-            try:
-                if prompt:
-                    process.stdin.write(prompt)
-            except (BrokenPipeError, OSError):
-                pass
-            finally:
-                try:
-                    process.stdin.close()
-                except (BrokenPipeError, OSError):
-                    pass
-
-        output_queue: queue.Queue[str | None] = queue.Queue()
-        raw_output_lines_holder = [0]
-        GRACEFUL_SHUTDOWN_DELAY = 0.3
-
-        def is_session_completed(line: str) -> bool:
-            try:
-                data = json.loads(line)
-                return data.get("type") in ("result", "error")
-            except (json.JSONDecodeError, AttributeError, TypeError):
-                return False
-
-        def read_output() -> None:
-            try:
-                if process.stdout:
-                    for line in iter(process.stdout.readline, ""):
-                        stripped = line.strip()
-                        output_queue.put(stripped)
-                        if stripped:
-                            raw_output_lines_holder[0] += 1
-                        if is_session_completed(stripped):
-                            time.sleep(GRACEFUL_SHUTDOWN_DELAY)
-                            break
-                    process.stdout.close()
-            except (OSError, IOError, ValueError):
-                pass
-            finally:
-                output_queue.put(None)
-
-        thread = threading.Thread(target=read_output, daemon=True)
-        thread.start()
-
-        def generator() -> Generator[str, None, tuple[Optional[int], int]]:
-            nonlocal thread
-            start_time = time.time()
-            last_activity_time = time.time()
-            timeout_error: CommandTimeoutError | None = None
-
-            while True:
-                now = time.time()
-
-                if max_duration > 0 and (now - start_time) >= max_duration:
-                    timeout_error = CommandTimeoutError(
-                        f"claude 执行超时（总时长超过 {max_duration}s）",
-                        is_idle=False
-                    )
-                    break
-
-                if (now - last_activity_time) >= timeout:
-                    timeout_error = CommandTimeoutError(
-                        f"claude 空闲超时（{timeout}s 无输出）",
-                        is_idle=True
-                    )
-                    break
-
-                try:
-                    line = output_queue.get(timeout=0.5)
-                    if line is None:
-                        break
-                    last_activity_time = time.time()
-                    if line:
-                        yield line
-                except queue.Empty:
-                    if process.poll() is not None and not thread.is_alive():
-                        break
-
-            if timeout_error is not None:
-                cleanup()
-                raise timeout_error
-
-            exit_code: Optional[int] = None
-            try:
-                exit_code = process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.terminate()
-                try:
-                    process.wait(timeout=2)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    process.wait()
-                timeout_error = CommandTimeoutError(
-                    "claude 进程等待超时",
-                    is_idle=False
-                )
-            finally:
-                if thread is not None:
-                    thread.join(timeout=5)
-
-            if timeout_error is not None:
-                raise timeout_error
-
-            while not output_queue.empty():
-                try:
-                    line = output_queue.get_nowait()
-                    if line is not None:
-                        yield line
-                except queue.Empty:
-                    break
-
-            return (exit_code, raw_output_lines_holder[0])
-
-        yield generator()
-
-    except Exception:
-        cleanup()
-        raise
-    finally:
-        cleanup()
-
-
-def _filter_last_lines(lines: list[str], max_lines: int = 50) -> list[str]:
-    import copy
-    filtered = []
+def _filter_last_lines(lines: Iterable[str], max_lines: int = 50) -> list[str]:
+    # 定长队列只保留最后 max_lines 行
+    filtered: deque[str] = deque(maxlen=max_lines)
     for line in lines:
+        # 不含 tool_result 的行无需脱敏，跳过 JSON 解析直接保留
+        if '"tool_result"' not in line:
+            filtered.append(line)
+            continue
         try:
-            data = json.loads(line)
+            data = json_loads(line)
             msg_type = data.get("type", "")
             if msg_type == "user":
                 message = data.get("message", {})
                 content = message.get("content")
                 if isinstance(content, list):
-                    data = copy.deepcopy(data)
-                    for block in data["message"]["content"]:
+                    # data 是刚解析出的新对象，不与任何数据共享引用，直接就地脱敏
+                    for block in content:
                         if isinstance(block, dict) and block.get("type") == "tool_result":
                             block["content"] = "[truncated]"
-                    filtered.append(json.dumps(data, ensure_ascii=False))
+                    filtered.append(json_dumps(data))
                 else:
                     filtered.append(line)
                 continue
             filtered.append(line)
         except (json.JSONDecodeError, TypeError, AttributeError):
             filtered.append(line)
-    return filtered[-max_lines:]
+    return list(filtered)
 
 
 def _build_error_detail(
@@ -374,12 +288,126 @@ def _build_error_detail(
     return detail
 
 
+# ============================================================================ 
+# 可重试错误判断
+# ============================================================================ 
+
+def _is_retryable_error(error_kind: Optional[str], err_message: str) -> bool:
+    """判断错误是否可以重试
+
+    上游错误、空闲超时、空结果等多为瞬时故障，可以重试。
+    排除：命令不存在、配置错误（需要用户干预）、未获取到 SESSION_ID（CLI 调用方式有误，重试无效）、
+    总时长超时（已经耗时太久）
+    """
+    return error_kind not in (
+        ErrorKind.COMMAND_NOT_FOUND,
+        ErrorKind.CONFIG_ERROR,
+        ErrorKind.PROTOCOL_MISSING_SESSION,
+        ErrorKind.TIMEOUT,
+    )
+
+
 # ============================================================================ 
 # Claude System Prompt
 # ============================================================================ 
 
 CLAUDE_SYSTEM_PROMPT = "你是一个高阶技术专家和咨询顾问。【角色定位】- 提供深度的技术见解和架构建议 - 能够执行复杂的代码重构或原型开发 - 保持专业、客观、严谨【输出规范】- 仅输出任务结果与必要的改动说明"
 
+# 与调用参数无关的命令前缀，模块加载时构建一次
+_CMD_BASE_RO = (
+    "claude",
+    "-p",
+    "--output-format", "stream-json",
+    "--verbose",
+    "--setting-sources", "project",
+    "--append-system-prompt", CLAUDE_SYSTEM_PROMPT,
+)
+_CMD_BASE_RW = _CMD_BASE_RO[:7] + ("--dangerously-skip-permissions",) + _CMD_BASE_RO[7:]
+
+# 限制同时运行的 claude CLI 进程数：每个进程都要加载 Node 并占用一个模型会话，
+# 无上限的并发会耗尽 CPU/内存并引发空闲超时与重试，反而放大负载
+_CLAUDE_SEM = asyncio.Semaphore(get_max_concurrency())
+
+# 将孤立的 \r 映射为 \n（\r\n 已先行合并），bytes.translate 单次扫描完成
+_CR_TO_LF = bytes.maketrans(b"\r", b"\n")
+
+
+# ============================================================================ 
+# stream-json 消息分派
+# ============================================================================ 
+
+class _StreamState:
+    """单次调用中从 stream-json 消息里累积的状态"""
+
+    __slots__ = (
+        "session_id",
+        "result_content",
+        "had_error",
+        "err_message",
+        "error_kind",
+        "assistant_buf",
+        "has_assistant_text",
+    )
+
+    def __init__(self) -> None:
+        self.session_id: Optional[str] = None
+        self.result_content = ""
+        self.had_error = False
+        self.err_message = ""
+        self.error_kind: Optional[str] = None
+        # 累积所有 assistant 消息的文本（多轮对话以空行拼接），边读边写入缓冲区，结束时无需再拼接
+        self.assistant_buf = io.StringIO()
+        self.has_assistant_text = False
+
+
+def _on_system(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    # 从 system/init 消息提取 session_id
+    if line_dict.get("subtype") == "init":
+        state.session_id = line_dict.get("session_id")
+
+
+def _on_assistant(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    # 提取 assistant 文本（多轮对话拼接）
+    message = line_dict.get("message", {})
+    content = message.get("content")
+    # JSON 解析结果只会是内置类型，type() is 精确比较即可，无需 isinstance
+    if type(content) is list:
+        for block in content:
+            if type(block) is dict and block.get("type") == "text":
+                text = block.get("text", "")
+                if text:
+                    if state.has_assistant_text:
+                        state.assistant_buf.write("\n\n")
+                    state.assistant_buf.write(text)
+                    state.has_assistant_text = True
+
+
+def _on_result(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    if "result" in line_dict:
+        state.result_content = line_dict.get("result", "")
+    if not state.session_id and "session_id" in line_dict:
+        state.session_id = line_dict.get("session_id")
+    if line_dict.get("is_error"):
+        state.had_error = True
+        state.err_message = line_dict.get("result", "") or line_dict.get("error", "")
+        state.error_kind = ErrorKind.UPSTREAM_ERROR
+
+
+def _on_error(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    state.had_error = True
+    error_data = line_dict.get("error", {})
+    state.err_message = error_data.get("message", str(line_dict))
+    state.error_kind = ErrorKind.UPSTREAM_ERROR
+
+
+# 按消息类型查表分派；占多数的 user 消息查不到处理函数，直接跳过
+_MESSAGE_HANDLERS = {
+    "system": _on_system,
+    "assistant": _on_assistant,
+    "result": _on_result,
+    "error": _on_error,
+}
+
 
 # ============================================================================ 
 # 主工具函数
@@ -425,23 +453,13 @@ async def claude_tool(
             result["metrics"] = metrics.to_dict()
         return result
 
-    cmd = [
-        "claude",
-        "-p",
-        "--output-format", "stream-json",
-        "--verbose",
-        "--setting-sources", "project",
-    ]
-
-    if sandbox != "read-only":
-        cmd.append("--dangerously-skip-permissions")
-
-    cmd.extend(["--append-system-prompt", CLAUDE_SYSTEM_PROMPT])
+    cmd = list(_CMD_BASE_RO if sandbox == "read-only" else _CMD_BASE_RW)
 
     if SESSION_ID:
         cmd.extend(["-r", SESSION_ID])
 
-    normalized_prompt = PROMPT.replace('\r\n', '\n').replace('\r', '\n')
+    # 统一换行符并一次性编码：重试时直接复用同一份 bytes
+    normalized_prompt = PROMPT.encode('utf-8').replace(b'\r\n', b'\n').translate(_CR_TO_LF)
 
     retries = 0
     last_error: Optional[Dict[str, Any]] = None
@@ -456,71 +474,66 @@ async def claude_tool(
         session_id: Optional[str] = None
         exit_code: Optional[int] = None
         raw_output_lines = 0
+        run_result = CommandResult()  # 子进程退出码与输出行数，由命令生成器填充
         json_decode_errors = 0
         error_kind: Optional[str] = None
-        last_lines: list[str] = []
-        assistant_text_parts: list[str] = []
+        last_lines: deque[str] = deque(maxlen=50)  # 仅保留最近 50 行用于错误诊断，内存占用与运行时长无关
+        state = _StreamState()
 
         try:
-            with safe_claude_command(cmd, env, cd, timeout, max_duration, prompt=normalized_prompt) as gen:
-                try:
-                    for line in gen:
-                        last_lines.append(line)
-                        if len(last_lines) > 50:
-                            last_lines.pop(0)
-
-                        try:
-                            line_dict = json.loads(line.strip())
-                            msg_type = line_dict.get("type", "")
-
-                            if return_all_messages:
-                                if msg_type == "user":
-                                    import copy
-                                    safe_dict = copy.deepcopy(line_dict)
-                                    message = safe_dict.get("message", {})
-                                    content = message.get("content")
-                                    if isinstance(content, list):
-                                        for block in content:
-                                            if isinstance(block, dict) and block.get("type") == "tool_result":
-                                                block["content"] = "[truncated]"
-                                    all_messages.append(safe_dict)
-                                else:
-                                    all_messages.append(line_dict)
-
-                            if msg_type == "system" and line_dict.get("subtype") == "init":
-                                session_id = line_dict.get("session_id")
-                            elif msg_type == "assistant":
+            async with _CLAUDE_SEM, safe_claude_command(cmd, env, cd, timeout, max_duration, prompt=normalized_prompt, result=run_result) as gen:
+                async for line in gen:
+                    last_lines.append(line)
+
+                    # 非 JSON 对象行（日志、警告等）无需进入解析器和异常处理；
+                    # stream-json 的帧都是对象，以 { 开头的行解析成功必然得到 dict
+                    if line[0] != "{":
+                        json_decode_errors += 1
+                        continue
+
+                    try:
+                        line_dict = json_loads(line)
+                        msg_type = line_dict.get("type", "")
+
+                        if return_all_messages:
+                            if msg_type == "user":
+                                # 浅层重建：只替换 tool_result 块，其余子树与原对象共享
+                                safe_dict = line_dict
                                 message = line_dict.get("message", {})
                                 content = message.get("content")
-                                if isinstance(content, list):
-                                    for block in content:
-                                        if isinstance(block, dict) and block.get("type") == "text":
-                                            text = block.get("text", "")
-                                            if text:
-                                                assistant_text_parts.append(text)
-                            elif msg_type == "result":
-                                if "result" in line_dict:
-                                    result_content = line_dict.get("result", "")
-                                if not session_id and "session_id" in line_dict:
-                                    session_id = line_dict.get("session_id")
-                                if line_dict.get("is_error"):
-                                    had_error = True
-                                    err_message = line_dict.get("result", "") or line_dict.get("error", "")
-                                    error_kind = ErrorKind.UPSTREAM_ERROR
-                            elif msg_type == "error":
-                                had_error = True
-                                error_data = line_dict.get("error", {})
-                                err_message = error_data.get("message", str(line_dict))
-                                error_kind = ErrorKind.UPSTREAM_ERROR
-                        except json.JSONDecodeError:
-                            json_decode_errors += 1
-                            continue
-                except StopIteration as e:
-                    if isinstance(e.value, tuple) and len(e.value) == 2:
-                        exit_code, raw_output_lines = e.value
-
-            if not result_content and assistant_text_parts:
-                result_content = "\n\n".join(assistant_text_parts)
+                                if type(content) is list:
+                                    safe_dict = {
+                                        **line_dict,
+                                        "message": {
+                                            **message,
+                                            "content": [
+                                                {**block, "content": "[truncated]"}
+                                                if type(block) is dict and block.get("type") == "tool_result"
+                                                else block
+                                                for block in content
+                                            ],
+                                        },
+                                    }
+                                all_messages.append(safe_dict)
+                            else:
+                                all_messages.append(line_dict)
+
+                        handler = _MESSAGE_HANDLERS.get(msg_type)
+                        if handler is not None:
+                            handler(line_dict, state)
+                    except json.JSONDecodeError:
+                        json_decode_errors += 1
+                        continue
+
+            session_id = state.session_id
+            result_content = state.result_content
+            had_error = state.had_error
+            err_message = state.err_message
+            error_kind = state.error_kind
+            if not result_content and state.has_assistant_text:
+                result_content = state.assistant_buf.getvalue()
+            exit_code = run_result.exit_code
+            raw_output_lines = run_result.raw_output_lines
 
         except CommandNotFoundError as e:
             metrics.finish(success=False, error_kind=ErrorKind.COMMAND_NOT_FOUND, retries=retries)
@@ -538,11 +551,12 @@ async def claude_tool(
             return result
 
         except CommandTimeoutError as e:
+            raw_output_lines = run_result.raw_output_lines
             error_kind = ErrorKind.IDLE_TIMEOUT if e.is_idle else ErrorKind.TIMEOUT
             had_error = True
             err_message = str(e)
             success = False
-            all_last_lines = last_lines.copy()
+            all_last_lines = list(last_lines)
             last_error = {
                 "error_kind": error_kind,
                 "err_message": err_message,
@@ -550,6 +564,11 @@ async def claude_tool(
                 "json_decode_errors": json_decode_errors,
                 "raw_output_lines": raw_output_lines,
             }
+            # 空闲超时可重试；总时长超时已经耗时太久，不再重试
+            if _is_retryable_error(error_kind, err_message) and retries < max_retries:
+                retries += 1
+                await asyncio.sleep(retry_policy(retries - 1))
+                continue
             break
 
         if had_error:
@@ -573,7 +592,7 @@ async def claude_tool(
         if success:
             break
         else:
-            all_last_lines = last_lines.copy()
+            all_last_lines = list(last_lines)
             last_error = {
                 "error_kind": error_kind,
                 "err_message": err_message,
@@ -581,9 +600,9 @@ async def claude_tool(
                 "json_decode_errors": json_decode_errors,
                 "raw_output_lines": raw_output_lines,
             }
-            if retries < max_retries:
+            if _is_retryable_error(error_kind, err_message) and retries < max_retries:
                 retries += 1
-                time.sleep(0.5 * (2 ** (retries - 1)))
+                await asyncio.sleep(retry_policy(retries - 1))
             else:
                 break
 
@@ -619,7 +638,7 @@ async def claude_tool(
             "error": err_message,
             "error_kind": error_kind,
             "error_detail": _build_error_detail(
-                message=err_message.split('\n')[0] if err_message else "未知错误",
+                message=err_message.partition('\n')[0] if err_message else "未知错误",
                 exit_code=exit_code,
                 last_lines=all_last_lines,
                 json_decode_errors=json_decode_errors,
@@ -6,37 +6,30 @@
 
 from __future__ import annotations
 
+import asyncio
+import io
 import json
-import queue
-import shutil
-import subprocess
-import sys
-import threading
 import time
-from contextlib import contextmanager
-from datetime import datetime, timezone
+from collections import deque
+from contextlib import AbstractAsyncContextManager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Annotated, Any, Dict, Generator, Iterator, Literal, Optional
+from typing import Annotated, Any, AsyncGenerator, Awaitable, Callable, Dict, Iterable, Literal, Optional
 
 from pydantic import Field
 
-from ccg_mcp.config import build_coder_env, get_config
-
-
-# ============================================================================
-# 错误类型定义
-# ============================================================================
-
-class CommandNotFoundError(Exception):
-    """命令不存在错误"""
-    pass
-
-
-class CommandTimeoutError(Exception):
-    """命令执行超时错误"""
-    def __init__(self, message: str, is_idle: bool = False):
-        super().__init__(message)
-        self.is_idle = is_idle  # 标记是否为空闲超时
+from ccg_mcp.config import build_coder_env, get_config, get_max_concurrency
+from ccg_mcp.tools._common import (
+    CommandNotFoundError,
+    CommandResult,
+    CommandTimeoutError,
+    json_dumps,
+    json_loads,
+    resolve_cli,
+    retry_policy,
+    safe_cli_command,
+    write_stderr_jsonl,
+)
 
 
 # ============================================================================
@@ -54,6 +47,7 @@ class ErrorKind:
     EMPTY_RESULT = "empty_result"
     SUBPROCESS_ERROR = "subprocess_error"
     CONFIG_ERROR = "config_error"
+    INVALID_ARGUMENTS = "invalid_arguments"  # multi 子调用的参数未通过校验
     UNEXPECTED_EXCEPTION = "unexpected_exception"
 
 
@@ -64,20 +58,41 @@ class ErrorKind:
 class MetricsCollector:
     """指标收集器"""
 
+    # 每次工具调用都会创建一个实例，固定属性集合，省去实例 __dict__
+    __slots__ = (
+        "tool",
+        "sandbox",
+        "prompt_chars",
+        "_prompt",
+        "ts_start",
+        "_t0",
+        "_finished",
+        "duration_ms",
+        "success",
+        "error_kind",
+        "retries",
+        "exit_code",
+        "result_chars",
+        "_result",
+        "raw_output_lines",
+        "json_decode_errors",
+    )
+
     def __init__(self, tool: str, prompt: str, sandbox: str):
         self.tool = tool
         self.sandbox = sandbox
         self.prompt_chars = len(prompt)
-        self.prompt_lines = prompt.count('\n') + 1
+        self._prompt = prompt  # 行数仅在输出指标时才统计
         self.ts_start = datetime.now(timezone.utc)
-        self.ts_end: Optional[datetime] = None
+        self._t0 = time.perf_counter_ns()  # 单调高精度计时，不受系统时钟调整影响
+        self._finished = False
         self.duration_ms: int = 0
         self.success: bool = False
         self.error_kind: Optional[str] = None
         self.retries: int = 0
         self.exit_code: Optional[int] = None
         self.result_chars: int = 0
-        self.result_lines: int = 0
+        self._result = ""
         self.raw_output_lines: int = 0
         self.json_decode_errors: int = 0
 
@@ -92,22 +107,40 @@ class MetricsCollector:
         retries: int = 0,
     ) -> None:
         """完成指标收集"""
-        self.ts_end = datetime.now(timezone.utc)
-        self.duration_ms = int((self.ts_end - self.ts_start).total_seconds() * 1000)
+        self.duration_ms = (time.perf_counter_ns() - self._t0) // 1_000_000
+        self._finished = True
         self.success = success
         self.error_kind = error_kind
         self.result_chars = len(result)
-        self.result_lines = result.count('\n') + 1 if result else 0
+        self._result = result
         self.exit_code = exit_code
         self.raw_output_lines = raw_output_lines
         self.json_decode_errors = json_decode_errors
         self.retries = retries
 
+    @property
+    def ts_end(self) -> Optional[datetime]:
+        """结束时间（由起始时间加耗时推算，finish 之前为 None）"""
+        if not self._finished:
+            return None
+        return self.ts_start + timedelta(milliseconds=self.duration_ms)
+
+    @property
+    def prompt_lines(self) -> int:
+        """Prompt 行数（按需统计，避免每次调用都扫描大 Prompt）"""
+        return self._prompt.count('\n') + 1
+
+    @property
+    def result_lines(self) -> int:
+        """结果行数（按需统计）"""
+        return self._result.count('\n') + 1 if self._result else 0
+
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典"""
+        ts_end = self.ts_end
         return {
             "ts_start": self.ts_start.isoformat() if self.ts_start else None,
-            "ts_end": self.ts_end.isoformat() if self.ts_end else None,
+            "ts_end": ts_end.isoformat() if ts_end else None,
             "duration_ms": self.duration_ms,
             "tool": self.tool,
             "sandbox": self.sandbox,
@@ -136,7 +169,7 @@ class MetricsCollector:
         # 移除 None 值以减少输出
         metrics = {k: v for k, v in metrics.items() if v is not None}
         try:
-            print(json.dumps(metrics, ensure_ascii=False), file=sys.stderr)
+            write_stderr_jsonl(metrics)
         except Exception:
             pass  # 静默失败，不影响主流程
 
@@ -145,392 +178,100 @@ class MetricsCollector:
 # 命令执行
 # ============================================================================
 
-def run_coder_command(
-    cmd: list[str],
-    env: dict[str, str],
-    cwd: Path | None = None,
-    timeout: int = 300,
-    max_duration: int = 1800,
-    prompt: str = "",
-) -> Generator[str, None, tuple[Optional[int], int]]:
-    """执行 Coder 命令并流式返回输出
-
-    Args:
-        cmd: 命令和参数列表
-        env: 环境变量字典
-        cwd: 工作目录
-        timeout: 空闲超时（秒），无输出超过此时间触发超时，默认 300 秒（5 分钟）
-        max_duration: 总时长硬上限（秒），默认 1800 秒（30 分钟），0 表示无限制
-        prompt: 通过 stdin 传递的对话 prompt
+# CLI 输出的 user 帧以 type 字段开头，只凭前缀即可识别，无需完整解析
+_USER_FRAME_PREFIX = b'{"type":"user"'
+# 跳过完整解析的 user 帧统一以此占位（只读，需要完整内容时从原始行重新解析）
+_USER_FRAME_HEAD: Dict[str, Any] = {"type": "user"}
 
-    Yields:
-        输出行
 
-    Returns:
-        (exit_code, raw_output_lines) 元组
-
-    Raises:
-        CommandNotFoundError: claude CLI 未安装时抛出
-        CommandTimeoutError: 命令执行超时时抛出
-    """
-    # 查找 claude CLI 路径
-    claude_path = shutil.which('claude')
-    if not claude_path:
-        raise CommandNotFoundError(
-            "未找到 claude CLI。请确保已安装 Claude Code CLI 并添加到 PATH。\n"
-            "安装指南：https://docs.anthropic.com/en/docs/claude-code"
-        )
-    popen_cmd = cmd.copy()
-    popen_cmd[0] = claude_path
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
-        errors='replace',  # 处理非 UTF-8 字符，避免 UnicodeDecodeError
-        env=env,
-        cwd=cwd,
-    )
-
-    # 通过 stdin 传递对话 prompt，然后关闭 stdin
-    if process.stdin:
-        try:
-            if prompt:
-                process.stdin.write(prompt)
-        except (BrokenPipeError, OSError):
-            pass
-        finally:
-            try:
-                process.stdin.close()
-            except (BrokenPipeError, OSError):
-                pass
-
-    output_queue: queue.Queue[str | None] = queue.Queue()
-    raw_output_lines = 0
-    GRACEFUL_SHUTDOWN_DELAY = 0.3
-
-    def is_session_completed(line: str) -> bool:
-        """检查是否会话完成（stream-json 格式）"""
-        try:
-            data = json.loads(line)
-            # stream-json 格式：result 或 error 类型表示会话结束
-            return data.get("type") in ("result", "error")
-        except (json.JSONDecodeError, AttributeError, TypeError):
-            return False
-
-    def read_output() -> None:
-        """在单独线程中读取进程输出"""
-        nonlocal raw_output_lines
-        if process.stdout:
-            for line in iter(process.stdout.readline, ""):
-                stripped = line.strip()
-                # 任意行都入队（触发活动判定），但只计数非空行
-                output_queue.put(stripped)
-                if stripped:
-                    raw_output_lines += 1
-                if is_session_completed(stripped):
-                    time.sleep(GRACEFUL_SHUTDOWN_DELAY)
-                    break
-            process.stdout.close()
-        output_queue.put(None)
-
-    thread = threading.Thread(target=read_output)
-    thread.start()
-
-    # 持续读取输出，带双重超时保障
-    start_time = time.time()
-    last_activity_time = time.time()
-    timeout_error: CommandTimeoutError | None = None
-
-    while True:
-        now = time.time()
-
-        # 检查总时长硬上限（优先级高）
-        if max_duration > 0 and (now - start_time) >= max_duration:
-            timeout_error = CommandTimeoutError(
-                f"coder 执行超时（总时长超过 {max_duration}s），进程已终止。",
-                is_idle=False
-            )
-            break
-
-        # 检查空闲超时
-        if (now - last_activity_time) >= timeout:
-            timeout_error = CommandTimeoutError(
-                f"coder 空闲超时（{timeout}s 无输出），进程已终止。",
-                is_idle=True
-            )
-            break
-
-        try:
-            line = output_queue.get(timeout=0.5)
-            if line is None:
-                break
-            # 有输出（包括空行），重置空闲计时器
-            last_activity_time = time.time()
-            if line:  # 非空行才 yield
-                yield line
-        except queue.Empty:
-            if process.poll() is not None and not thread.is_alive():
-                break
-
-    # 如果超时，终止进程
-    if timeout_error is not None:
-        process.terminate()
-        try:
-            process.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
-        thread.join(timeout=5)
-        raise timeout_error
-
-    exit_code: Optional[int] = None
+def _parse_frame(raw: bytes) -> tuple[bytes, Any]:
+    """解析一行输出为 (原始行, JSON)；每行只解析一次，非 JSON 对象行解析结果为 None"""
+    if raw[0] != 0x7B:  # b"{"
+        return raw, None  # 非 JSON 对象行（日志、警告等）无需进入解析器和异常处理，解析成功的行必然是 dict
     try:
-        exit_code = process.wait(timeout=5)  # 此时进程应已结束，短超时即可
-    except subprocess.TimeoutExpired:
-        process.terminate()
-        try:
-            process.wait(timeout=2)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
-        # 进程等待超时（罕见情况），视为总时长超时
-        timeout_error = CommandTimeoutError(
-            f"coder 进程等待超时，进程已终止。",
-            is_idle=False
-        )
-    finally:
-        thread.join(timeout=5)
+        return raw, json_loads(raw)  # 直接解析 bytes，省去一次解码后再编码
+    except ValueError:  # JSONDecodeError，或非法 UTF-8 的 UnicodeDecodeError
+        return raw, None
 
-    if timeout_error is not None:
-        raise timeout_error
 
-    # 读取剩余输出（不再累加 raw_output_lines，避免重复计数）
-    while not output_queue.empty():
-        try:
-            line = output_queue.get_nowait()
-            if line is not None:
-                yield line
-        except queue.Empty:
-            break
+def _parse_frame_skip_user(raw: bytes) -> tuple[bytes, Any]:
+    """同 _parse_frame，但 user 帧（包含 tool_result，通常是体积最大的行）只凭前缀识别，不做完整解析"""
+    if raw.startswith(_USER_FRAME_PREFIX):
+        return raw, _USER_FRAME_HEAD
+    return _parse_frame(raw)
+
 
-    # 返回退出码和原始输出行数
-    return (exit_code, raw_output_lines)
+def _is_session_completed(frame: tuple[bytes, Any]) -> bool:
+    """stream-json 格式：result 或 error 类型表示会话结束"""
+    data = frame[1]
+    return type(data) is dict and data.get("type") in ("result", "error")
 
 
-@contextmanager
 def safe_coder_command(
     cmd: list[str],
     env: dict[str, str],
     cwd: Path | None = None,
     timeout: int = 300,
     max_duration: int = 1800,
-    prompt: str = "",
-) -> Iterator[Generator[str, None, tuple[Optional[int], int]]]:
-    """安全执行 Coder 命令的上下文管理器
+    prompt: str | bytes = "",
+    parse_user_frames: bool = True,
+    result: Optional[CommandResult] = None,
+) -> AbstractAsyncContextManager[AsyncGenerator[tuple[bytes, Any], None]]:
+    """安全执行 Coder 命令的异步上下文管理器，逐行产出 (原始输出行 bytes, 解析后的 JSON)
 
-    确保在任何情况下（包括异常）都能正确清理子进程。
+    子进程管理、超时与清理见 run_cli_command / safe_cli_command。原始行不做解码，
+    仅在错误诊断等需要文本时才解码。parse_user_frames 为 False 时 user 帧不做完整解析，
+    解析结果为 _USER_FRAME_HEAD 占位。
 
     用法:
-        with safe_coder_command(cmd, env, cwd, timeout, max_duration, prompt) as gen:
-            for line in gen:
-                process_line(line)
+        async with safe_coder_command(cmd, env, cwd, timeout, max_duration, prompt) as gen:
+            async for line, data in gen:
+                process_line(line, data)
+
+    Raises:
+        CommandNotFoundError: claude CLI 未安装时抛出
     """
     # 查找 claude CLI 路径
-    claude_path = shutil.which('claude')
-    if not claude_path:
+    try:
+        claude_path = resolve_cli('claude')
+    except FileNotFoundError:
         raise CommandNotFoundError(
             "未找到 claude CLI。请确保已安装 Claude Code CLI 并添加到 PATH。\n"
             "安装指南：https://docs.anthropic.com/en/docs/claude-code"
-        )
-    popen_cmd = cmd.copy()
-    popen_cmd[0] = claude_path
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
-        errors='replace',  # 处理非 UTF-8 字符，避免 UnicodeDecodeError
+        ) from None
+    return safe_cli_command(
+        [claude_path, *cmd[1:]],
+        name="coder",
+        prompt=prompt,
         env=env,
         cwd=cwd,
+        timeout=timeout,
+        max_duration=max_duration,
+        parse=_parse_frame if parse_user_frames else _parse_frame_skip_user,
+        is_done=_is_session_completed,
+        result=result,
     )
 
-    thread: Optional[threading.Thread] = None
-
-    def cleanup() -> None:
-        """清理子进程和线程（best-effort，不抛异常）"""
-        nonlocal thread
-        # 1. 先关闭 stdout 以解除读取线程的阻塞
-        try:
-            if process.stdout and not process.stdout.closed:
-                process.stdout.close()
-        except (OSError, IOError):
-            pass
-        # 2. 终止进程
-        try:
-            if process.poll() is None:
-                process.terminate()
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    try:
-                        process.wait(timeout=2)  # kill 后也设超时
-                    except subprocess.TimeoutExpired:
-                        pass  # 极端情况：进程无法终止，放弃
-        except (ProcessLookupError, OSError):
-            pass  # 进程已退出，忽略
-        # 3. 等待线程结束
-        if thread is not None and thread.is_alive():
-            thread.join(timeout=5)
-
-    try:
-        # 通过 stdin 传递对话 prompt，然后关闭 stdin
-        if process.stdin:
-            try:
-                if prompt:
-                    process.stdin.write(prompt)
-            except (BrokenPipeError, OSError):
-                pass
-            finally:
-                try:
-                    process.stdin.close()
-                except (BrokenPipeError, OSError):
-                    pass
-
-        output_queue: queue.Queue[str | None] = queue.Queue()
-        raw_output_lines_holder = [0]  # 使用列表以便在嵌套函数中修改
-        GRACEFUL_SHUTDOWN_DELAY = 0.3
-
-        def is_session_completed(line: str) -> bool:
-            """检查是否会话完成（stream-json 格式）"""
-            try:
-                data = json.loads(line)
-                # stream-json 格式：result 或 error 类型表示会话结束
-                return data.get("type") in ("result", "error")
-            except (json.JSONDecodeError, AttributeError, TypeError):
-                return False
-
-        def read_output() -> None:
-            """在单独线程中读取进程输出"""
-            try:
-                if process.stdout:
-                    for line in iter(process.stdout.readline, ""):
-                        stripped = line.strip()
-                        output_queue.put(stripped)
-                        if stripped:
-                            raw_output_lines_holder[0] += 1
-                        if is_session_completed(stripped):
-                            time.sleep(GRACEFUL_SHUTDOWN_DELAY)
-                            break
-                    process.stdout.close()
-            except (OSError, IOError, ValueError):
-                pass  # stdout 被关闭，正常退出
-            finally:
-                output_queue.put(None)  # 确保投递哨兵
-
-        thread = threading.Thread(target=read_output, daemon=True)
-        thread.start()
-
-        def generator() -> Generator[str, None, tuple[Optional[int], int]]:
-            """生成器：读取输出并处理超时"""
-            nonlocal thread
-            start_time = time.time()
-            last_activity_time = time.time()
-            timeout_error: CommandTimeoutError | None = None
-
-            while True:
-                now = time.time()
-
-                if max_duration > 0 and (now - start_time) >= max_duration:
-                    timeout_error = CommandTimeoutError(
-                        f"coder 执行超时（总时长超过 {max_duration}s），进程已终止。",
-                        is_idle=False
-                    )
-                    break
-
-                if (now - last_activity_time) >= timeout:
-                    timeout_error = CommandTimeoutError(
-                        f"coder 空闲超时（{timeout}s 无输出），进程已终止。",
-                        is_idle=True
-                    )
-                    break
-
-                try:
-                    line = output_queue.get(timeout=0.5)
-                    if line is None:
-                        break
-                    last_activity_time = time.time()
-                    if line:
-                        yield line
-                except queue.Empty:
-                    if process.poll() is not None and not thread.is_alive():
-                        break
 
-            if timeout_error is not None:
-                cleanup()
-                raise timeout_error
-
-            exit_code: Optional[int] = None
-            try:
-                exit_code = process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.terminate()
-                try:
-                    process.wait(timeout=2)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    process.wait()
-                timeout_error = CommandTimeoutError(
-                    f"coder 进程等待超时，进程已终止。",
-                    is_idle=False
-                )
-            finally:
-                if thread is not None:
-                    thread.join(timeout=5)
-
-            if timeout_error is not None:
-                raise timeout_error
-
-            while not output_queue.empty():
-                try:
-                    line = output_queue.get_nowait()
-                    if line is not None:
-                        yield line
-                except queue.Empty:
-                    break
-
-            return (exit_code, raw_output_lines_holder[0])
-
-        yield generator()
-
-    except Exception:
-        cleanup()
-        raise
-    finally:
-        # 确保在退出上下文时清理
-        cleanup()
-
-
-def _filter_last_lines(lines: list[str], max_lines: int = 50) -> list[str]:
+def _filter_last_lines(lines: Iterable[tuple[bytes, Any]], max_lines: int = 50) -> list[str]:
     """过滤 last_lines，脱敏 tool_result 中的大内容
 
     stream-json 格式的 user 消息通常包含 tool_result，其中可能有大量文件内容。
     这里只脱敏 tool_result 的 content 字段，保留消息结构和所有其他上下文。
+    lines 为读取时已解析好的 (原始行 bytes, JSON) 元组，不再重复解析，原始行在此才解码。
     """
-    import copy
-    filtered = []
-    for line in lines:
+    # 定长队列只保留最后 max_lines 行
+    filtered: deque[str] = deque(maxlen=max_lines)
+    for raw, data in lines:
+        line = raw.decode('utf-8', errors='replace')
+        # 不含 tool_result 的行、非 JSON 行无需脱敏，直接保留
+        if data is None or b'"tool_result"' not in raw:
+            filtered.append(line)
+            continue
         try:
-            data = json.loads(line)
+            if data is _USER_FRAME_HEAD:
+                # 读取时跳过了完整解析，此处补上（仅错误路径）
+                data = json_loads(raw)
             msg_type = data.get("type", "")
 
             # 脱敏 user 消息中的 tool_result 内容（就地修改，保留完整结构）
@@ -539,13 +280,12 @@ def _filter_last_lines(lines: list[str], max_lines: int = 50) -> list[str]:
                 content = message.get("content")
                 # 类型防御：只处理 list 类型的 content
                 if isinstance(content, list):
-                    # 深拷贝以避免修改原始数据
-                    data = copy.deepcopy(data)
-                    for block in data["message"]["content"]:
+                    # all_messages 中的 user 消息已替换掉 tool_result 块，不共享这些块，直接就地脱敏
+                    for block in content:
                         if isinstance(block, dict) and block.get("type") == "tool_result":
                             # 只替换 content 字段，保留其他所有字段
                             block["content"] = "[truncated]"
-                    filtered.append(json.dumps(data, ensure_ascii=False))
+                    filtered.append(json_dumps(data))
                 else:
                     # content 不是 list，原样保留（可能格式异常）
                     filtered.append(line)
@@ -554,16 +294,16 @@ def _filter_last_lines(lines: list[str], max_lines: int = 50) -> list[str]:
             # 其他消息类型正常保留
             filtered.append(line)
         except (json.JSONDecodeError, TypeError, AttributeError):
-            # 非 JSON 行正常保留
+            # 结构异常的 JSON 行正常保留
             filtered.append(line)
 
-    return filtered[-max_lines:]
+    return list(filtered)
 
 
 def _build_error_detail(
     message: str,
     exit_code: Optional[int] = None,
-    last_lines: Optional[list[str]] = None,
+    last_lines: Optional[list[tuple[bytes, Any]]] = None,
     json_decode_errors: int = 0,
     idle_timeout_s: Optional[int] = None,
     max_duration_s: Optional[int] = None,
@@ -594,12 +334,157 @@ def _build_error_detail(
     return detail
 
 
+# ============================================================================
+# 可重试错误判断
+# ============================================================================
+
+def _is_retryable_error(error_kind: Optional[str], err_message: str) -> bool:
+    """判断错误是否可以重试
+
+    上游错误、空闲超时、空结果等多为瞬时故障，可以重试。
+    排除：命令不存在、配置错误（需要用户干预）、未获取到 SESSION_ID（CLI 调用方式有误，重试无效）、
+    总时长超时（已经耗时太久）
+    """
+    return error_kind not in (
+        ErrorKind.COMMAND_NOT_FOUND,
+        ErrorKind.CONFIG_ERROR,
+        ErrorKind.PROTOCOL_MISSING_SESSION,
+        ErrorKind.TIMEOUT,
+    )
+
+
 # ============================================================================
 # Coder System Prompt
 # ============================================================================
 
 CODER_SYSTEM_PROMPT = "你是一个专注高效的代码执行助手。【执行原则】- 直接执行任务，不闲聊、不反问需求 - 遵循代码最佳实践，保持代码质量 - 在任务范围内可自主决策实现细节【输出规范】- 仅输出任务结果与必要的改动说明 - 如有代码改动可附 diff（内容较多时节选关键部分并说明）"
 
+# 与调用参数无关的命令前缀（按逻辑分层排序），模块加载时构建一次
+_CMD_BASE_RO = (
+    "claude",
+    "-p",                                    # 1. 运行模式
+    "--output-format", "stream-json",        # 2. 输出格式（流式 JSON，支持中间状态）
+    "--verbose",                             # 3. stream-json 在 -p 模式下需要 --verbose
+    "--setting-sources", "project",          # 4. 设置源（仅加载项目级设置）
+    "--append-system-prompt", CODER_SYSTEM_PROMPT,  # 6. 全局设定（Prompt 注入）
+)
+# 5. 安全策略：非只读模式跳过权限确认（插在全局设定之前）
+_CMD_BASE_RW = _CMD_BASE_RO[:7] + ("--dangerously-skip-permissions",) + _CMD_BASE_RO[7:]
+
+# 限制同时运行的 coder CLI 进程数：每个进程都要加载 Node 并占用一个模型会话，
+# 无上限的并发会耗尽 CPU/内存并引发空闲超时与重试，反而放大负载
+_CODER_SEM = asyncio.Semaphore(get_max_concurrency())
+
+# 将孤立的 \r 映射为 \n（\r\n 已先行合并），bytes.translate 单次扫描完成
+_CR_TO_LF = bytes.maketrans(b"\r", b"\n")
+
+
+# ============================================================================
+# stream-json 消息分派
+# ============================================================================
+
+class _StreamState:
+    """单次调用中从 stream-json 消息里累积的状态"""
+
+    __slots__ = (
+        "session_id",
+        "result_content",
+        "had_error",
+        "err_message",
+        "error_kind",
+        "assistant_buf",
+        "has_assistant_text",
+    )
+
+    def __init__(self) -> None:
+        self.session_id: Optional[str] = None
+        self.result_content = ""
+        self.had_error = False
+        self.err_message = ""
+        self.error_kind: Optional[str] = None
+        # 累积所有 assistant 消息的文本（多轮对话以空行拼接），边读边写入缓冲区，结束时无需再拼接
+        self.assistant_buf = io.StringIO()
+        self.has_assistant_text = False
+
+
+def _on_system(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    # S0.3: 从 system/init 消息提取 session_id
+    if line_dict.get("subtype") == "init":
+        state.session_id = line_dict.get("session_id")
+
+
+def _on_assistant(line_dict: Dict[str, Any], state: _StreamState) -> Optional[list[str]]:
+    # S0.4: 从 assistant 消息提取文本（多轮对话拼接），返回新增文本供调用方作为增量输出
+    message = line_dict.get("message", {})
+    content = message.get("content")
+    # 类型守卫：只处理 list 类型的 content（JSON 解析结果只会是内置类型，type() is 精确比较即可，无需 isinstance）
+    if type(content) is not list:
+        return None
+    deltas: list[str] = []
+    for block in content:
+        if type(block) is dict and block.get("type") == "text":
+            text = block.get("text", "")
+            if text:
+                if state.has_assistant_text:
+                    state.assistant_buf.write("\n\n")
+                state.assistant_buf.write(text)
+                state.has_assistant_text = True
+                deltas.append(text)
+    return deltas
+
+
+def _on_result(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    # stream-json 的 result 可能包含完整结果或仅包含 stats
+    if "result" in line_dict:
+        state.result_content = line_dict.get("result", "")
+    # session_id 也可能在 result 中（兼容）
+    if not state.session_id and "session_id" in line_dict:
+        state.session_id = line_dict.get("session_id")
+    if line_dict.get("is_error"):
+        state.had_error = True
+        state.err_message = line_dict.get("result", "") or line_dict.get("error", "")
+        state.error_kind = ErrorKind.UPSTREAM_ERROR
+
+
+def _on_error(line_dict: Dict[str, Any], state: _StreamState) -> None:
+    state.had_error = True
+    error_data = line_dict.get("error", {})
+    state.err_message = error_data.get("message", str(line_dict))
+    state.error_kind = ErrorKind.UPSTREAM_ERROR
+
+
+# 按消息类型查表分派；占多数的 user 消息查不到处理函数，直接跳过。
+# 处理函数返回需要作为增量输出的文本列表（无则返回 None）
+_MESSAGE_HANDLERS: Dict[str, Callable[[Dict[str, Any], _StreamState], Optional[list[str]]]] = {
+    "system": _on_system,
+    "assistant": _on_assistant,
+    "result": _on_result,
+    "error": _on_error,
+}
+
+
+def _redact_user_message(line_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """脱敏 user 消息中的 tool_result 内容
+
+    浅层重建：只替换 tool_result 块，其余子树与原对象共享，避免深拷贝大段文件内容。
+    """
+    message = line_dict.get("message", {})
+    content = message.get("content")
+    if type(content) is not list:
+        return line_dict
+    return {
+        **line_dict,
+        "message": {
+            **message,
+            "content": [
+                {**block, "content": "[truncated]"}
+                if type(block) is dict and block.get("type") == "tool_result"
+                else block
+                for block in content
+            ],
+        },
+    }
+
 
 # ============================================================================
 # 主工具函数
@@ -619,6 +504,10 @@ async def coder_tool(
     max_duration: Annotated[int, "总时长硬上限（秒），默认 1800 秒（30 分钟），0 表示无限制"] = 1800,
     max_retries: Annotated[int, "最大重试次数，默认 0（不重试）"] = 0,
     log_metrics: Annotated[bool, "是否将指标输出到 stderr"] = False,
+    on_chunk: Annotated[
+        Optional[Callable[[str], Awaitable[None]]],
+        "增量输出回调：每解析到一段 assistant 文本即以该文本 await 调用",
+    ] = None,
 ) -> Dict[str, Any]:
     """执行 Coder 代码任务
 
@@ -634,6 +523,9 @@ async def coder_tool(
 
     **注意**：Coder 需要写权限，默认 sandbox 为 workspace-write
     **重试策略**：Coder 默认不重试（有写入副作用），除非显式设置 max_retries
+    **增量输出**：传入 on_chunk 时边执行边回调 assistant 文本，重试时新一轮尝试的文本会继续回调，
+    以返回值为准。on_chunk 在持有并发名额、子进程仍在运行时被 await，应尽快返回；
+    它抛出的异常会终止子进程并原样向上传播
     """
     # 初始化指标收集器
     metrics = MetricsCollector(tool="coder", prompt=PROMPT, sandbox=sandbox)
@@ -659,34 +551,22 @@ async def coder_tool(
             result["metrics"] = metrics.to_dict()
         return result
 
-    # 构建命令（按逻辑分层排序）
-    cmd = [
-        "claude",
-        "-p",                                    # 1. 运行模式
-        "--output-format", "stream-json",        # 2. 输出格式（流式 JSON，支持中间状态）
-        "--verbose",                             # 3. stream-json 在 -p 模式下需要 --verbose
-        "--setting-sources", "project",          # 4. 设置源（仅加载项目级设置）
-    ]
-
-    # 5. 安全策略
-    if sandbox != "read-only":
-        cmd.append("--dangerously-skip-permissions")
-
-    # 6. 全局设定（Prompt 注入）
-    cmd.extend(["--append-system-prompt", CODER_SYSTEM_PROMPT])
+    # 构建命令：1-6 为预构建的静态前缀
+    cmd = list(_CMD_BASE_RO if sandbox == "read-only" else _CMD_BASE_RW)
 
     # 7. 动态变量（会话恢复）
     if SESSION_ID:
         cmd.extend(["-r", SESSION_ID])
 
     # 处理对话 PROMPT 中的换行符（确保跨平台兼容）
-    normalized_prompt = PROMPT.replace('\r\n', '\n').replace('\r', '\n')
+    # 统一换行符并一次性编码：重试时直接复用同一份 bytes
+    normalized_prompt = PROMPT.encode('utf-8').replace(b'\r\n', b'\n').translate(_CR_TO_LF)
     # 对话 prompt 通过 stdin 传递，system prompt 通过 --append-system-prompt 命令行参数传递
 
     # 执行循环（支持重试）
     retries = 0
     last_error: Optional[Dict[str, Any]] = None
-    all_last_lines: list[str] = []
+    all_last_lines: list[tuple[bytes, Any]] = []
 
     while retries <= max_retries:
         all_messages: list[Dict[str, Any]] = []
@@ -697,92 +577,61 @@ async def coder_tool(
         session_id: Optional[str] = None
         exit_code: Optional[int] = None
         raw_output_lines = 0
+        run_result = CommandResult()  # 子进程退出码与输出行数，由命令生成器填充
         json_decode_errors = 0
         error_kind: Optional[str] = None
-        last_lines: list[str] = []
-        assistant_text_parts: list[str] = []  # 累积所有 assistant 消息的文本（多轮对话拼接）
+        # (原始行, 解析结果)，仅保留最近 50 行用于错误诊断，内存占用与运行时长无关
+        last_lines: deque[tuple[bytes, Any]] = deque(maxlen=50)
+        state = _StreamState()
 
         try:
-            with safe_coder_command(cmd, env, cd, timeout, max_duration, prompt=normalized_prompt) as gen:
-                try:
-                    for line in gen:
-                        last_lines.append(line)
-                        if len(last_lines) > 50:  # 增加到 50 行以便更好的诊断
-                            last_lines.pop(0)
-
-                        try:
-                            line_dict = json.loads(line.strip())
-                            msg_type = line_dict.get("type", "")
-
-                            # 收集完整消息（user 消息需要脱敏 tool_result）
-                            if return_all_messages:
-                                if msg_type == "user":
-                                    # 脱敏 user 消息中的 tool_result 内容
-                                    import copy
-                                    safe_dict = copy.deepcopy(line_dict)
-                                    message = safe_dict.get("message", {})
-                                    content = message.get("content")
-                                    if isinstance(content, list):
-                                        for block in content:
-                                            if isinstance(block, dict) and block.get("type") == "tool_result":
-                                                block["content"] = "[truncated]"
-                                    all_messages.append(safe_dict)
-                                else:
-                                    all_messages.append(line_dict)
-
-                            # S0.3: 从 system/init 消息提取 session_id
-                            if msg_type == "system" and line_dict.get("subtype") == "init":
-                                session_id = line_dict.get("session_id")
-
-                            # S0.4: 从 assistant 消息提取文本（多轮对话拼接）
-                            elif msg_type == "assistant":
-                                message = line_dict.get("message", {})
-                                content = message.get("content")
-                                # 类型守卫：只处理 list 类型的 content
-                                if isinstance(content, list):
-                                    for block in content:
-                                        if isinstance(block, dict):
-                                            if block.get("type") == "text":
-                                                text = block.get("text", "")
-                                                if text:
-                                                    assistant_text_parts.append(text)
-
-                            # 处理 result 类型（stream-json 中可能也有）
-                            elif msg_type == "result":
-                                # stream-json 的 result 可能包含完整结果或仅包含 stats
-                                if "result" in line_dict:
-                                    result_content = line_dict.get("result", "")
-                                # session_id 也可能在 result 中（兼容）
-                                if not session_id and "session_id" in line_dict:
-                                    session_id = line_dict.get("session_id")
-                                if line_dict.get("is_error"):
-                                    had_error = True
-                                    err_message = line_dict.get("result", "") or line_dict.get("error", "")
-                                    error_kind = ErrorKind.UPSTREAM_ERROR
-
-                            elif msg_type == "error":
-                                had_error = True
-                                error_data = line_dict.get("error", {})
-                                err_message = error_data.get("message", str(line_dict))
-                                error_kind = ErrorKind.UPSTREAM_ERROR
-
-                        except json.JSONDecodeError:
-                            json_decode_errors += 1
-                            continue
-
-                        except Exception as error:
-                            err_message += f"\n\n[unexpected error] {error}. Line: {line!r}"
-                            had_error = True
-                            error_kind = ErrorKind.UNEXPECTED_EXCEPTION
-                            break
-                except StopIteration as e:
-                    # 正确捕获生成器返回值
-                    if isinstance(e.value, tuple) and len(e.value) == 2:
-                        exit_code, raw_output_lines = e.value
+            # 不收集完整消息时，user 帧只需知道类型，跳过完整解析
+            async with _CODER_SEM, safe_coder_command(
+                cmd, env, cd, timeout, max_duration,
+                prompt=normalized_prompt,
+                parse_user_frames=return_all_messages,
+                result=run_result,
+            ) as gen:
+                async for line, line_dict in gen:
+                    last_lines.append((line, line_dict))
+
+                    if line_dict is None:
+                        json_decode_errors += 1
+                        continue
+
+                    deltas = None
+                    try:
+                        msg_type = line_dict.get("type", "")
 
+                        # 收集完整消息（user 消息需要脱敏 tool_result）
+                        if return_all_messages:
+                            all_messages.append(_redact_user_message(line_dict) if msg_type == "user" else line_dict)
+
+                        handler = _MESSAGE_HANDLERS.get(msg_type)
+                        if handler is not None:
+                            deltas = handler(line_dict, state)
+
+                    except Exception as error:
+                        state.err_message += f"\n\n[unexpected error] {error}. Line: {line.decode('utf-8', errors='replace')!r}"
+                        state.had_error = True
+                        state.error_kind = ErrorKind.UNEXPECTED_EXCEPTION
+                        break
+
+                    # 回调放在 try 之外：调用方的异常不会被记为 UNEXPECTED_EXCEPTION
+                    if deltas and on_chunk is not None:
+                        for text in deltas:
+                            await on_chunk(text)
+
+            session_id = state.session_id
+            result_content = state.result_content
+            had_error = state.had_error
+            err_message = state.err_message
+            error_kind = state.error_kind
             # 如果没有从 result 获取到内容，拼接所有 assistant 消息的文本
-            if not result_content and assistant_text_parts:
-                result_content = "\n\n".join(assistant_text_parts)
+            if not result_content and state.has_assistant_text:
+                result_content = state.assistant_buf.getvalue()
+            exit_code = run_result.exit_code
+            raw_output_lines = run_result.raw_output_lines
 
         except CommandNotFoundError as e:
             metrics.finish(
@@ -805,13 +654,13 @@ async def coder_tool(
             return result
 
         except CommandTimeoutError as e:
+            raw_output_lines = run_result.raw_output_lines
             # 根据异常属性区分空闲超时和总时长超时
             error_kind = ErrorKind.IDLE_TIMEOUT if e.is_idle else ErrorKind.TIMEOUT
             had_error = True
             err_message = str(e)
             success = False  # 明确设置为失败
-            # 超时不重试（已经耗时太久），保存错误信息后跳出
-            all_last_lines = last_lines.copy()
+            all_last_lines = list(last_lines)
             last_error = {
                 "error_kind": error_kind,
                 "err_message": err_message,
@@ -819,6 +668,11 @@ async def coder_tool(
                 "json_decode_errors": json_decode_errors,
                 "raw_output_lines": raw_output_lines,
             }
+            # 空闲超时可重试；总时长超时已经耗时太久，不再重试
+            if _is_retryable_error(error_kind, err_message) and retries < max_retries:
+                retries += 1
+                await asyncio.sleep(retry_policy(retries - 1))
+                continue
             break
 
         # 综合判断成功与否
@@ -849,7 +703,7 @@ async def coder_tool(
             break
         else:
             # 失败，保存错误信息
-            all_last_lines = last_lines.copy()
+            all_last_lines = list(last_lines)
             last_error = {
                 "error_kind": error_kind,
                 "err_message": err_message,
@@ -858,10 +712,10 @@ async def coder_tool(
                 "raw_output_lines": raw_output_lines,
             }
             # 检查是否需要重试
-            if retries < max_retries:
+            if _is_retryable_error(error_kind, err_message) and retries < max_retries:
                 retries += 1
-                # 指数退避
-                time.sleep(0.5 * (2 ** (retries - 1)))
+                # 带抖动的指数退避
+                await asyncio.sleep(retry_policy(retries - 1))
             else:
                 break
 
@@ -901,7 +755,7 @@ async def coder_tool(
             "error": err_message,
             "error_kind": error_kind,
             "error_detail": _build_error_detail(
-                message=err_message.split('\n')[0] if err_message else "未知错误",
+                message=err_message.partition('\n')[0] if err_message else "未知错误",
                 exit_code=exit_code,
                 last_lines=all_last_lines,
                 json_decode_errors=json_decode_errors,
@@ -919,3 +773,4 @@ async def coder_tool(
         result["metrics"] = metrics.to_dict()
 
     return result
+
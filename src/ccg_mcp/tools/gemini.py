@@ -6,36 +6,29 @@ Gemini CLI 作为一个强大的子代理（Sub-agent），由主架构师（Gem
 
 from __future__ import annotations
 
+import asyncio
 import json
-import queue
-import shutil
-import subprocess
-import sys
-import threading
 import time
-from contextlib import contextmanager
-from datetime import datetime, timezone
+from collections import deque
+from contextlib import AbstractAsyncContextManager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Annotated, Any, Dict, Generator, Iterator, List, Literal, Optional
+from typing import Annotated, Any, AsyncGenerator, Dict, List, Literal, Optional
 
 from pydantic import Field
 
-
-# ============================================================================
-# 错误类型定义
-# ============================================================================
-
-class CommandNotFoundError(Exception):
-    """命令不存在错误"""
-    pass
-
-
-class CommandTimeoutError(Exception):
-    """命令执行超时错误"""
-    def __init__(self, message: str, is_idle: bool = False):
-        super().__init__(message)
-        self.is_idle = is_idle  # 标记是否为空闲超时
-
+from ccg_mcp.tools._common import (
+    CommandNotFoundError,
+    CommandResult,
+    CommandTimeoutError,
+    decode_line,
+    json_dumps,
+    json_loads,
+    resolve_cli,
+    retry_policy,
+    safe_cli_command,
+    write_stderr_jsonl,
+)
 
 # ============================================================================
 # 错误类型枚举
@@ -52,6 +45,7 @@ class ErrorKind:
     PROTOCOL_MISSING_SESSION = "protocol_missing_session"
     EMPTY_RESULT = "empty_result"
     SUBPROCESS_ERROR = "subprocess_error"
+    INVALID_ARGUMENTS = "invalid_arguments"  # multi 子调用的参数未通过校验
     UNEXPECTED_EXCEPTION = "unexpected_exception"
 
 
@@ -62,20 +56,41 @@ class ErrorKind:
 class MetricsCollector:
     """指标收集器"""
 
+    # 每次工具调用都会创建一个实例，固定属性集合，省去实例 __dict__
+    __slots__ = (
+        "tool",
+        "sandbox",
+        "prompt_chars",
+        "_prompt",
+        "ts_start",
+        "_t0",
+        "_finished",
+        "duration_ms",
+        "success",
+        "error_kind",
+        "retries",
+        "exit_code",
+        "result_chars",
+        "_result",
+        "raw_output_lines",
+        "json_decode_errors",
+    )
+
     def __init__(self, tool: str, prompt: str, sandbox: str):
         self.tool = tool
         self.sandbox = sandbox
         self.prompt_chars = len(prompt)
-        self.prompt_lines = prompt.count('\n') + 1
+        self._prompt = prompt  # 行数仅在输出指标时才统计
         self.ts_start = datetime.now(timezone.utc)
-        self.ts_end: Optional[datetime] = None
+        self._t0 = time.perf_counter_ns()  # 单调高精度计时，不受系统时钟调整影响
+        self._finished = False
         self.duration_ms: int = 0
         self.success: bool = False
         self.error_kind: Optional[str] = None
         self.retries: int = 0
         self.exit_code: Optional[int] = None
         self.result_chars: int = 0
-        self.result_lines: int = 0
+        self._result = ""
         self.raw_output_lines: int = 0
         self.json_decode_errors: int = 0
 
@@ -90,22 +105,40 @@ class MetricsCollector:
         retries: int = 0,
     ) -> None:
         """完成指标收集"""
-        self.ts_end = datetime.now(timezone.utc)
-        self.duration_ms = int((self.ts_end - self.ts_start).total_seconds() * 1000)
+        self.duration_ms = (time.perf_counter_ns() - self._t0) // 1_000_000
+        self._finished = True
         self.success = success
         self.error_kind = error_kind
         self.result_chars = len(result)
-        self.result_lines = result.count('\n') + 1 if result else 0
+        self._result = result
         self.exit_code = exit_code
         self.raw_output_lines = raw_output_lines
         self.json_decode_errors = json_decode_errors
         self.retries = retries
 
+    @property
+    def ts_end(self) -> Optional[datetime]:
+        """结束时间（由起始时间加耗时推算，finish 之前为 None）"""
+        if not self._finished:
+            return None
+        return self.ts_start + timedelta(milliseconds=self.duration_ms)
+
+    @property
+    def prompt_lines(self) -> int:
+        """Prompt 行数（按需统计，避免每次调用都扫描大 Prompt）"""
+        return self._prompt.count('\n') + 1
+
+    @property
+    def result_lines(self) -> int:
+        """结果行数（按需统计）"""
+        return self._result.count('\n') + 1 if self._result else 0
+
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典"""
+        ts_end = self.ts_end
         return {
             "ts_start": self.ts_start.isoformat() if self.ts_start else None,
-            "ts_end": self.ts_end.isoformat() if self.ts_end else None,
+            "ts_end": ts_end.isoformat() if ts_end else None,
             "duration_ms": self.duration_ms,
             "tool": self.tool,
             "sandbox": self.sandbox,
@@ -134,7 +167,7 @@ class MetricsCollector:
         # 移除 None 值以减少输出
         metrics = {k: v for k, v in metrics.items() if v is not None}
         try:
-            print(json.dumps(metrics, ensure_ascii=False), file=sys.stderr)
+            write_stderr_jsonl(metrics)
         except Exception:
             pass  # 静默失败，不影响主流程
 
@@ -143,373 +176,55 @@ class MetricsCollector:
 # 命令执行
 # ============================================================================
 
-def run_gemini_command(
-    cmd: list[str],
-    timeout: int = 300,
-    max_duration: int = 1800,
-    prompt: str = "",
-    cwd: Optional[Path] = None,
-) -> Generator[str, None, tuple[Optional[int], int]]:
-    """执行 Gemini 命令并流式返回输出
-
-    Args:
-        cmd: 命令和参数列表
-        timeout: 空闲超时（秒），无输出超过此时间触发超时，默认 300 秒（5 分钟）
-        max_duration: 总时长硬上限（秒），默认 1800 秒（30 分钟），0 表示无限制
-        prompt: 通过 stdin 传递的 prompt 内容
-        cwd: 工作目录
-
-    Yields:
-        输出行
-
-    Returns:
-        (exit_code, raw_output_lines) 元组
-
-    Raises:
-        CommandNotFoundError: gemini CLI 未安装时抛出
-        CommandTimeoutError: 命令执行超时时抛出
-    """
-    gemini_path = shutil.which('gemini')
-    if not gemini_path:
-        raise CommandNotFoundError(
-            "未找到 gemini CLI。请确保已安装 Gemini CLI 并添加到 PATH。\n"
-            "安装指南：https://github.com/google-gemini/gemini-cli"
-        )
-    popen_cmd = cmd.copy()
-    popen_cmd[0] = gemini_path
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
-        errors='replace',  # 处理非 UTF-8 字符，避免 UnicodeDecodeError
-        cwd=str(cwd) if cwd else None,
-    )
-
-    # 通过 stdin 传递 prompt，然后关闭 stdin
-    if process.stdin:
-        try:
-            if prompt:
-                process.stdin.write(prompt)
-        except (BrokenPipeError, OSError):
-            # 子进程可能已退出，忽略写入错误
-            pass
-        finally:
-            try:
-                process.stdin.close()
-            except (BrokenPipeError, OSError):
-                pass
-
-    output_queue: queue.Queue[str | None] = queue.Queue()
-    raw_output_lines = 0
-    GRACEFUL_SHUTDOWN_DELAY = 0.3
-
-    def is_turn_completed(line: str) -> bool:
-        """检查是否回合完成"""
-        try:
-            data = json.loads(line)
-            # Gemini CLI 使用 turn.completed 表示回合完成，result 表示执行结束
-            return data.get("type") in ("turn.completed", "result")
-        except (json.JSONDecodeError, AttributeError, TypeError):
-            return False
-
-    def read_output() -> None:
-        """在单独线程中读取进程输出"""
-        nonlocal raw_output_lines
-        if process.stdout:
-            for line in iter(process.stdout.readline, ""):
-                stripped = line.strip()
-                # 任意行都入队（触发活动判定），但只计数非空行
-                output_queue.put(stripped)
-                if stripped:
-                    raw_output_lines += 1
-                if is_turn_completed(stripped):
-                    # 等待剩余输出被 drain
-                    time.sleep(GRACEFUL_SHUTDOWN_DELAY)
-                    break
-            process.stdout.close()
-        output_queue.put(None)
-
-    thread = threading.Thread(target=read_output)
-    thread.start()
-
-    # 持续读取输出，带双重超时保障
-    start_time = time.time()
-    last_activity_time = time.time()
-    timeout_error: CommandTimeoutError | None = None
-
-    while True:
-        now = time.time()
-
-        # 检查总时长硬上限（优先级高）
-        if max_duration > 0 and (now - start_time) >= max_duration:
-            timeout_error = CommandTimeoutError(
-                f"gemini 执行超时（总时长超过 {max_duration}s），进程已终止。",
-                is_idle=False
-            )
-            break
-
-        # 检查空闲超时
-        if (now - last_activity_time) >= timeout:
-            timeout_error = CommandTimeoutError(
-                f"gemini 空闲超时（{timeout}s 无输出），进程已终止。",
-                is_idle=True
-            )
-            break
-
-        try:
-            line = output_queue.get(timeout=0.5)
-            if line is None:
-                break
-            # 有输出（包括空行），重置空闲计时器
-            last_activity_time = time.time()
-            if line:  # 非空行才 yield
-                yield line
-        except queue.Empty:
-            if process.poll() is not None and not thread.is_alive():
-                break
-
-    # 如果超时，终止进程
-    if timeout_error is not None:
-        process.terminate()
-        try:
-            process.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
-        thread.join(timeout=5)
-        raise timeout_error
-
-    exit_code: Optional[int] = None
+def _is_turn_completed(line: str) -> bool:
+    """检查是否回合完成"""
     try:
-        exit_code = process.wait(timeout=5)  # 此时进程应已结束，短超时即可
-    except subprocess.TimeoutExpired:
-        process.terminate()
-        try:
-            process.wait(timeout=2)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
-        # 进程等待超时（罕见情况），视为总时长超时
-        timeout_error = CommandTimeoutError(
-            f"gemini 进程等待超时，进程已终止。",
-            is_idle=False
-        )
-    finally:
-        thread.join(timeout=5)
-
-    if timeout_error is not None:
-        raise timeout_error
-
-    # 读取剩余输出（不再累加 raw_output_lines，避免重复计数）
-    while not output_queue.empty():
-        try:
-            line = output_queue.get_nowait()
-            if line is not None:
-                yield line
-        except queue.Empty:
-            break
-
-    # 返回退出码和原始输出行数
-    return (exit_code, raw_output_lines)
+        data = json_loads(line)
+        # Gemini CLI 使用 turn.completed 表示回合完成，result 表示执行结束
+        return data.get("type") in ("turn.completed", "result")
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        return False
 
 
-@contextmanager
 def safe_gemini_command(
     cmd: list[str],
     timeout: int = 300,
     max_duration: int = 1800,
     prompt: str = "",
     cwd: Optional[Path] = None,
-) -> Iterator[Generator[str, None, tuple[Optional[int], int]]]:
-    """安全执行 Gemini 命令的上下文管理器
+    result: Optional[CommandResult] = None,
+) -> AbstractAsyncContextManager[AsyncGenerator[str, None]]:
+    """安全执行 Gemini 命令的异步上下文管理器，逐行产出解码后的输出
 
-    确保在任何情况下（包括异常）都能正确清理子进程。
+    子进程管理、超时与清理见 run_cli_command / safe_cli_command。
 
     用法:
-        with safe_gemini_command(cmd, timeout, max_duration, prompt, cwd) as gen:
-            for line in gen:
+        async with safe_gemini_command(cmd, timeout, max_duration, prompt, cwd) as gen:
+            async for line in gen:
                 process_line(line)
+
+    Raises:
+        CommandNotFoundError: gemini CLI 未安装时抛出
     """
-    gemini_path = shutil.which('gemini')
-    if not gemini_path:
+    try:
+        gemini_path = resolve_cli('gemini')
+    except FileNotFoundError:
         raise CommandNotFoundError(
             "未找到 gemini CLI。请确保已安装 Gemini CLI 并添加到 PATH。\n"
             "安装指南：https://github.com/google-gemini/gemini-cli"
-        )
-    popen_cmd = cmd.copy()
-    popen_cmd[0] = gemini_path
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
-        errors='replace',  # 处理非 UTF-8 字符，避免 UnicodeDecodeError
-        cwd=str(cwd) if cwd else None,
+        ) from None
+    return safe_cli_command(
+        [gemini_path, *cmd[1:]],
+        name="gemini",
+        prompt=prompt,
+        cwd=cwd,
+        timeout=timeout,
+        max_duration=max_duration,
+        parse=decode_line,
+        is_done=_is_turn_completed,
+        result=result,
     )
 
-    thread: Optional[threading.Thread] = None
-
-    def cleanup() -> None:
-        """清理子进程和线程（best-effort，不抛异常）"""
-        nonlocal thread
-        # 1. 先关闭 stdout 以解除读取线程的阻塞
-        try:
-            if process.stdout and not process.stdout.closed:
-                process.stdout.close()
-        except (OSError, IOError):
-            pass
-        # 2. 终止进程
-        try:
-            if process.poll() is None:
-                process.terminate()
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    try:
-                        process.wait(timeout=2)  # kill 后也设超时
-                    except subprocess.TimeoutExpired:
-                        pass  # 极端情况：进程无法终止，放弃
-        except (ProcessLookupError, OSError):
-            pass  # 进程已退出，忽略
-        # 3. 等待线程结束
-        if thread is not None and thread.is_alive():
-            thread.join(timeout=5)
-
-    try:
-        # 通过 stdin 传递 prompt，然后关闭 stdin
-        if process.stdin:
-            try:
-                if prompt:
-                    process.stdin.write(prompt)
-            except (BrokenPipeError, OSError):
-                pass
-            finally:
-                try:
-                    process.stdin.close()
-                except (BrokenPipeError, OSError):
-                    pass
-
-        output_queue: queue.Queue[str | None] = queue.Queue()
-        raw_output_lines_holder = [0]
-        GRACEFUL_SHUTDOWN_DELAY = 0.3
-
-        def is_turn_completed(line: str) -> bool:
-            """检查是否回合完成"""
-            try:
-                data = json.loads(line)
-                return data.get("type") == "turn.completed"
-            except (json.JSONDecodeError, AttributeError, TypeError):
-                return False
-
-        def read_output() -> None:
-            """在单独线程中读取进程输出"""
-            try:
-                if process.stdout:
-                    for line in iter(process.stdout.readline, ""):
-                        stripped = line.strip()
-                        output_queue.put(stripped)
-                        if stripped:
-                            raw_output_lines_holder[0] += 1
-                        if is_turn_completed(stripped):
-                            time.sleep(GRACEFUL_SHUTDOWN_DELAY)
-                            break
-                    process.stdout.close()
-            except (OSError, IOError, ValueError):
-                pass  # stdout 被关闭，正常退出
-            finally:
-                output_queue.put(None)  # 确保投递哨兵
-
-        thread = threading.Thread(target=read_output, daemon=True)
-        thread.start()
-
-        def generator() -> Generator[str, None, tuple[Optional[int], int]]:
-            """生成器：读取输出并处理超时"""
-            nonlocal thread
-            start_time = time.time()
-            last_activity_time = time.time()
-            timeout_error: CommandTimeoutError | None = None
-
-            while True:
-                now = time.time()
-
-                if max_duration > 0 and (now - start_time) >= max_duration:
-                    timeout_error = CommandTimeoutError(
-                        f"gemini 执行超时（总时长超过 {max_duration}s），进程已终止。",
-                        is_idle=False
-                    )
-                    break
-
-                if (now - last_activity_time) >= timeout:
-                    timeout_error = CommandTimeoutError(
-                        f"gemini 空闲超时（{timeout}s 无输出），进程已终止。",
-                        is_idle=True
-                    )
-                    break
-
-                try:
-                    line = output_queue.get(timeout=0.5)
-                    if line is None:
-                        break
-                    last_activity_time = time.time()
-                    if line:
-                        yield line
-                except queue.Empty:
-                    if process.poll() is not None and not thread.is_alive():
-                        break
-
-            if timeout_error is not None:
-                cleanup()
-                raise timeout_error
-
-            exit_code: Optional[int] = None
-            try:
-                exit_code = process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.terminate()
-                try:
-                    process.wait(timeout=2)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    process.wait()
-                timeout_error = CommandTimeoutError(
-                    f"gemini 进程等待超时，进程已终止。",
-                    is_idle=False
-                )
-            finally:
-                if thread is not None:
-                    thread.join(timeout=5)
-
-            if timeout_error is not None:
-                raise timeout_error
-
-            while not output_queue.empty():
-                try:
-                    line = output_queue.get_nowait()
-                    if line is not None:
-                        yield line
-                except queue.Empty:
-                    break
-
-            return (exit_code, raw_output_lines_holder[0])
-
-        yield generator()
-
-    except Exception:
-        cleanup()
-        raise
-    finally:
-        cleanup()
-
 
 def _filter_last_lines(lines: list[str], max_lines: int = 50) -> list[str]:
     """过滤 last_lines，脱敏 tool_result 中的大内容
@@ -517,19 +232,21 @@ def _filter_last_lines(lines: list[str], max_lines: int = 50) -> list[str]:
     Gemini 的 JSONL 格式：tool_result 是独立的事件类型（type == "tool_result"）。
     这里只脱敏 tool_result 的 content 字段，保留消息结构和所有其他上下文。
     """
-    import copy
     filtered = []
     for line in lines:
+        # 不含 tool_result 的行无需脱敏，跳过 JSON 解析直接保留
+        if '"tool_result"' not in line:
+            filtered.append(line)
+            continue
         try:
-            data = json.loads(line)
+            data = json_loads(line)
             event_type = data.get("type", "")
 
-            # 脱敏 tool_result 内容
+            # 脱敏 tool_result 内容（data 是刚解析出的新对象，直接就地修改）
             if event_type == "tool_result":
-                data = copy.deepcopy(data)
                 if "content" in data:
                     data["content"] = "[truncated]"
-                filtered.append(json.dumps(data, ensure_ascii=False))
+                filtered.append(json_dumps(data))
                 continue
 
             # 其他消息类型正常保留
@@ -605,12 +322,15 @@ def _is_retryable_error(error_kind: Optional[str], err_message: str) -> bool:
     """判断错误是否可以重试
 
     Gemini 默认 yolo 模式，大部分错误都可以安全重试。
-    排除：命令不存在（需要用户干预）、认证错误（需要用户登录）
+    排除：命令不存在（需要用户干预）、认证错误（需要用户登录）、
+    未获取到 SESSION_ID（CLI 调用方式有误，重试无效）
     """
     if error_kind == ErrorKind.COMMAND_NOT_FOUND:
         return False
     if error_kind == ErrorKind.AUTH_REQUIRED:
         return False
+    if error_kind == ErrorKind.PROTOCOL_MISSING_SESSION:
+        return False
     # 其他错误都可以重试
     return True
 
@@ -719,88 +439,84 @@ async def gemini_tool(
         session_id: Optional[str] = None
         exit_code: Optional[int] = None
         raw_output_lines = 0
+        run_result = CommandResult()  # 子进程退出码与输出行数，由命令生成器填充
         json_decode_errors = 0
         error_kind: Optional[str] = None
-        last_lines: list[str] = []
+        last_lines: deque[str] = deque(maxlen=50)  # 仅保留最近 50 行用于错误诊断，内存占用与运行时长无关
 
         try:
-            with safe_gemini_command(cmd, timeout=timeout, max_duration=max_duration, prompt=PROMPT, cwd=cd) as gen:
-                try:
-                    for line in gen:
-                        last_lines.append(line)
-                        if len(last_lines) > 50:
-                            last_lines.pop(0)
-
-                        try:
-                            line_dict = json.loads(line.strip())
-
-                            # stream-json 事件类型: init, message, tool_use, tool_result, error, result
-                            # 参考: https://geminicli.com/docs/cli/headless/
-                            event_type = line_dict.get("type", "")
-
-                            # 收集消息（脱敏 tool_result 内容）
-                            if return_all_messages:
-                                import copy
-                                safe_dict = copy.deepcopy(line_dict)
-                                # Gemini 的 tool_result 是独立事件类型
-                                if event_type == "tool_result":
-                                    # 脱敏 content 字段
-                                    if "content" in safe_dict:
-                                        safe_dict["content"] = "[truncated]"
-                                all_messages.append(safe_dict)
-
-                            # 提取 message 事件中的内容
-                            if event_type == "message":
-                                # message 事件包含 role 和 content
-                                role = line_dict.get("role", "")
-                                content = line_dict.get("content", "")
-                                if role == "assistant" and content:
-                                    agent_messages += content
-
-                            # 提取 result 事件（最终统计）
-                            if event_type == "result":
-                                # result 事件包含 response 和统计信息
-                                response = line_dict.get("response", "")
-                                if response:
-                                    # 如果 result 中有完整响应，使用它
-                                    if not agent_messages:
-                                        agent_messages = response
-
-                            # 提取 session_id (Gemini 可能在 init 事件中返回)
-                            if event_type == "init":
-                                if line_dict.get("session_id") is not None:
-                                    session_id = line_dict.get("session_id")
-                                if line_dict.get("thread_id") is not None:
-                                    session_id = line_dict.get("thread_id")
-
-                            # 错误处理
-                            # 注意：AUTH_REQUIRED 优先级最高，一旦设置不再被覆盖
-                            if event_type == "error":
-                                had_error = True
-                                error_msg = line_dict.get("message", str(line_dict))
-                                err_message += "\n\n[gemini error] " + error_msg
-                                # 检查是否为认证错误（优先级高于 UPSTREAM_ERROR）
-                                if _is_auth_error(error_msg):
-                                    error_kind = ErrorKind.AUTH_REQUIRED
-                                elif error_kind != ErrorKind.AUTH_REQUIRED:
-                                    error_kind = ErrorKind.UPSTREAM_ERROR
-
-                        except json.JSONDecodeError:
-                            # JSON 解析失败，记录错误计数
-                            json_decode_errors += 1
-                            # 非 JSON 输出记录到日志但不作为响应内容
-                            # 避免将 CLI 警告/错误文本误认为成功结果
-                            continue
-
-                        except Exception as error:
-                            err_message += f"\n\n[unexpected error] {error}. Line: {line!r}"
+            async with safe_gemini_command(cmd, timeout=timeout, max_duration=max_duration, prompt=PROMPT, cwd=cd, result=run_result) as gen:
+                async for line in gen:
+                    last_lines.append(line)
+
+                    try:
+                        line_dict = json_loads(line)
+
+                        # stream-json 事件类型: init, message, tool_use, tool_result, error, result
+                        # 参考: https://geminicli.com/docs/cli/headless/
+                        event_type = line_dict.get("type", "")
+
+                        # 收集消息（脱敏 tool_result 内容）
+                        if return_all_messages:
+                            safe_dict = line_dict
+                            # Gemini 的 tool_result 是独立事件类型
+                            if event_type == "tool_result":
+                                # 脱敏 content 字段：浅拷贝顶层后替换，无需深拷贝
+                                if "content" in line_dict:
+                                    safe_dict = {**line_dict, "content": "[truncated]"}
+                            all_messages.append(safe_dict)
+
+                        # 提取 message 事件中的内容
+                        if event_type == "message":
+                            # message 事件包含 role 和 content
+                            role = line_dict.get("role", "")
+                            content = line_dict.get("content", "")
+                            if role == "assistant" and content:
+                                agent_messages += content
+
+                        # 提取 result 事件（最终统计）
+                        if event_type == "result":
+                            # result 事件包含 response 和统计信息
+                            response = line_dict.get("response", "")
+                            if response:
+                                # 如果 result 中有完整响应，使用它
+                                if not agent_messages:
+                                    agent_messages = response
+
+                        # 提取 session_id (Gemini 可能在 init 事件中返回)
+                        if event_type == "init":
+                            if line_dict.get("session_id") is not None:
+                                session_id = line_dict.get("session_id")
+                            if line_dict.get("thread_id") is not None:
+                                session_id = line_dict.get("thread_id")
+
+                        # 错误处理
+                        # 注意：AUTH_REQUIRED 优先级最高，一旦设置不再被覆盖
+                        if event_type == "error":
                             had_error = True
-                            error_kind = ErrorKind.UNEXPECTED_EXCEPTION
-                            break
-                except StopIteration as e:
-                    # 正确捕获生成器返回值
-                    if isinstance(e.value, tuple) and len(e.value) == 2:
-                        exit_code, raw_output_lines = e.value
+                            error_msg = line_dict.get("message", str(line_dict))
+                            err_message += "\n\n[gemini error] " + error_msg
+                            # 检查是否为认证错误（优先级高于 UPSTREAM_ERROR）
+                            if _is_auth_error(error_msg):
+                                error_kind = ErrorKind.AUTH_REQUIRED
+                            elif error_kind != ErrorKind.AUTH_REQUIRED:
+                                error_kind = ErrorKind.UPSTREAM_ERROR
+
+                    except json.JSONDecodeError:
+                        # JSON 解析失败，记录错误计数
+                        json_decode_errors += 1
+                        # 非 JSON 输出记录到日志但不作为响应内容
+                        # 避免将 CLI 警告/错误文本误认为成功结果
+                        continue
+
+                    except Exception as error:
+                        err_message += f"\n\n[unexpected error] {error}. Line: {line!r}"
+                        had_error = True
+                        error_kind = ErrorKind.UNEXPECTED_EXCEPTION
+                        break
+
+            exit_code = run_result.exit_code
+            raw_output_lines = run_result.raw_output_lines
 
         except CommandNotFoundError as e:
             metrics.finish(
@@ -823,6 +539,7 @@ async def gemini_tool(
             return result
 
         except CommandTimeoutError as e:
+            raw_output_lines = run_result.raw_output_lines
             # 根据异常属性区分空闲超时和总时长超时
             error_kind = ErrorKind.IDLE_TIMEOUT if e.is_idle else ErrorKind.TIMEOUT
             had_error = True
@@ -830,7 +547,7 @@ async def gemini_tool(
             success = False
             # 超时可以重试
             if retries < max_retries:
-                all_last_lines = last_lines.copy()
+                all_last_lines = list(last_lines)
                 last_error = {
                     "error_kind": error_kind,
                     "err_message": err_message,
@@ -839,11 +556,11 @@ async def gemini_tool(
                     "raw_output_lines": raw_output_lines,
                 }
                 retries += 1
-                time.sleep(0.5 * (2 ** (retries - 1)))
+                await asyncio.sleep(retry_policy(retries - 1))
                 continue
             else:
                 # 已达最大重试次数
-                all_last_lines = last_lines.copy()
+                all_last_lines = list(last_lines)
                 last_error = {
                     "error_kind": error_kind,
                     "err_message": err_message,
@@ -885,7 +602,7 @@ async def gemini_tool(
         else:
             # 检查是否可重试
             if _is_retryable_error(error_kind, err_message) and retries < max_retries:
-                all_last_lines = last_lines.copy()
+                all_last_lines = list(last_lines)
                 last_error = {
                     "error_kind": error_kind,
                     "err_message": err_message,
@@ -894,11 +611,11 @@ async def gemini_tool(
                     "raw_output_lines": raw_output_lines,
                 }
                 retries += 1
-                # 指数退避
-                time.sleep(0.5 * (2 ** (retries - 1)))
+                # 带抖动的指数退避
+                await asyncio.sleep(retry_policy(retries - 1))
             else:
                 # 不可重试或已达到最大重试次数
-                all_last_lines = last_lines.copy()
+                all_last_lines = list(last_lines)
                 last_error = {
                     "error_kind": error_kind,
                     "err_message": err_message,
@@ -956,7 +673,7 @@ async def gemini_tool(
             "error": err_message,
             "error_kind": error_kind,
             "error_detail": _build_error_detail(
-                message=err_message.split('\n')[0] if err_message else "未知错误",
+                message=err_message.partition('\n')[0] if err_message else "未知错误",
                 exit_code=exit_code,
                 last_lines=all_last_lines,
                 json_decode_errors=json_decode_errors,